@@ -1,17 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from logging import getLogger
+from queue import Queue
 from time import monotonic
 from typing import Any, List, Optional, Tuple
 
 from PIL import Image
 
-from ..output import save_image
-from ..params import ImageParams, StageParams
+from ..output import save_debug_image
+from ..params import ImageParams, StageParams, TileOrder
 from ..server import ServerContext
-from ..utils import is_debug
 from ..worker import ProgressCallback, WorkerContext
 from .stage import BaseStage
-from .tile import needs_tile, process_tile_order
+from .tile import (
+    choose_tile_size,
+    generate_tile_spiral,
+    needs_tile,
+    plan_tile_grid,
+    process_tile_order,
+)
 
 logger = getLogger(__name__)
 
@@ -57,6 +64,9 @@ class ChainPipeline:
         """
         self.stages = list(stages or [])
 
+        # tile schedules keyed by geometry, reused across images with the same size
+        self.tile_schedules = {}
+
     def append(self, stage: Optional[PipelineStage]):
         """
         Append an additional stage to this pipeline.
@@ -82,6 +92,278 @@ class ChainPipeline:
         self.stages.append((callback, params, kwargs))
         return self
 
+    def plan_tiles(
+        self,
+        source: Image.Image,
+        stage_params: StageParams,
+        tile: int,
+        overlap: Optional[float] = None,
+    ) -> List[Tuple[int, int]]:
+        """
+        Plan the tile schedule for a source image, reusing the cached schedule when
+        successive images share the same geometry.
+        """
+        if stage_params.tile_order == TileOrder.spiral:
+            overlap = 0.5 if overlap is None else overlap
+        else:
+            overlap = 0.0 if overlap is None else overlap
+
+        key = (source.size, tile, overlap, stage_params.tile_order)
+        coords = self.tile_schedules.get(key)
+        if coords is None:
+            if stage_params.tile_order == TileOrder.spiral:
+                coords = generate_tile_spiral(
+                    source.width, source.height, tile, overlap=overlap
+                )
+            else:
+                coords = plan_tile_grid(
+                    source.width, source.height, tile, overlap=overlap
+                )
+
+            self.tile_schedules[key] = coords
+
+        return coords
+
+    def run_stage(
+        self,
+        job: WorkerContext,
+        server: ServerContext,
+        params: ImageParams,
+        stage: PipelineStage,
+        stage_sources: List[Image.Image],
+        callback: Optional[ProgressCallback],
+        pipeline_kwargs: dict,
+    ) -> List[Image.Image]:
+        """
+        Run a single stage over a list of sources, tiling them as needed.
+        """
+        stage_pipe, stage_params, stage_kwargs = stage
+        name = stage_params.name or stage_pipe.__class__.__name__
+        kwargs = stage_kwargs or {}
+        kwargs = {**pipeline_kwargs, **kwargs}
+        logger.debug(
+            "running stage %s with %s source images, parameters: %s",
+            name,
+            len(stage_sources) - stage_sources.count(None),
+            kwargs.keys(),
+        )
+
+        # the stage must be split and tiled if any image is larger than the selected/max tile size
+        must_tile = any(
+            [
+                needs_tile(
+                    stage_pipe.max_tile,
+                    stage_params.tile_size,
+                    size=kwargs.get("size", None),
+                    source=source,
+                )
+                for source in stage_sources
+            ]
+        )
+
+        tile = stage_params.tile_size
+        if stage_pipe.max_tile > 0:
+            tile = min(stage_pipe.max_tile, stage_params.tile_size)
+
+        if must_tile:
+            stage_outputs = []
+            for source in stage_sources:
+                if (
+                    stage_pipe.resize_fast_path
+                    and source is not None
+                    and max(source.width, source.height) <= int(tile * 1.05)
+                ):
+                    # the image barely overflows the tile, so resizing it to fit a
+                    # single tile is much cheaper than splitting it into a full grid
+                    logger.debug(
+                        "image of %s barely overflows tile size of %s, resizing to fit",
+                        source.size,
+                        tile,
+                    )
+                    # fit the long side to the tile and keep the aspect ratio,
+                    # forcing a square would stretch non-square images
+                    fit = tile / max(source.width, source.height)
+                    scaled = source.resize(
+                        (
+                            max(1, round(source.width * fit)),
+                            max(1, round(source.height * fit)),
+                        ),
+                        Image.Resampling.LANCZOS,
+                    )
+                    result = stage_pipe.run(
+                        job,
+                        server,
+                        stage_params,
+                        params,
+                        [scaled],
+                        callback=callback,
+                        **kwargs,
+                    )[0]
+                    stage_outputs.append(
+                        result.resize(
+                            (
+                                source.width * stage_params.outscale,
+                                source.height * stage_params.outscale,
+                            ),
+                            Image.Resampling.LANCZOS,
+                        )
+                    )
+                    continue
+
+                source_tile = tile
+                if source is not None:
+                    # even out the tile size for this image so borderline sizes do not
+                    # produce a final tile that is only a few pixels wide
+                    source_tile = max(
+                        choose_tile_size(source.width, tile),
+                        choose_tile_size(source.height, tile),
+                    )
+                    if source_tile != tile:
+                        logger.debug(
+                            "adjusted tile size from %s to %s for image of %s",
+                            tile,
+                            source_tile,
+                            source.size,
+                        )
+
+                logger.info(
+                    "image larger than tile size of %s, tiling stage",
+                    source_tile,
+                )
+
+                def stage_tile(
+                    source_tile: Image.Image,
+                    tile_mask: Image.Image,
+                    dims: Tuple[int, int, int],
+                ) -> Image.Image:
+                    output_tile = stage_pipe.run(
+                        job,
+                        server,
+                        stage_params,
+                        params,
+                        [source_tile],
+                        tile_mask=tile_mask,
+                        callback=callback,
+                        dims=dims,
+                        **kwargs,
+                    )[0]
+
+                    save_debug_image(server, "last-tile.png", output_tile)
+
+                    return output_tile
+
+                tile_coords = None
+                if source is not None and "size" not in kwargs:
+                    tile_coords = self.plan_tiles(
+                        source,
+                        stage_params,
+                        source_tile,
+                        overlap=kwargs.get("overlap", None),
+                    )
+
+                output = process_tile_order(
+                    stage_params.tile_order,
+                    source,
+                    source_tile,
+                    stage_params.outscale,
+                    [stage_tile],
+                    tile_coords=tile_coords,
+                    **kwargs,
+                )
+                stage_outputs.append(output)
+
+            stage_sources = stage_outputs
+        else:
+            logger.debug("image within tile size of %s, running stage", tile)
+            stage_sources = stage_pipe.run(
+                job,
+                server,
+                stage_params,
+                params,
+                stage_sources,
+                callback=callback,
+                **kwargs,
+            )
+
+        logger.debug(
+            "finished stage %s with %s results",
+            name,
+            len(stage_sources),
+        )
+
+        save_debug_image(server, "last-stage.png", stage_sources[0])
+
+        return stage_sources
+
+    def run_parallel(
+        self,
+        job: WorkerContext,
+        server: ServerContext,
+        params: ImageParams,
+        sources: List[Image.Image],
+        callback: Optional[ProgressCallback],
+        pipeline_kwargs: dict,
+    ) -> List[Image.Image]:
+        """
+        Run the stages as a producer/consumer pipeline, one worker thread per stage with
+        bounded queues between them, so the stages run concurrently on different sources.
+        """
+        eof = object()
+        queues = [Queue(maxsize=2) for _ in range(len(self.stages) + 1)]
+        logger.debug(
+            "running %s stages as a pipeline over %s sources",
+            len(self.stages),
+            len(sources),
+        )
+
+        def stage_worker(index: int) -> None:
+            stage = self.stages[index]
+            source_queue = queues[index]
+            output_queue = queues[index + 1]
+            try:
+                while True:
+                    source = source_queue.get()
+                    if source is eof:
+                        return
+
+                    for output in self.run_stage(
+                        job, server, params, stage, [source], callback, pipeline_kwargs
+                    ):
+                        output_queue.put(output)
+            except Exception:
+                # drain the remaining inputs so upstream workers do not block on a full queue
+                while source_queue.get() is not eof:
+                    pass
+
+                raise
+            finally:
+                # always signal the next stage, even after an error, to avoid deadlock
+                output_queue.put(eof)
+
+        def feed_sources() -> None:
+            for source in sources:
+                queues[0].put(source)
+
+            queues[0].put(eof)
+
+        with ThreadPoolExecutor(max_workers=len(self.stages) + 1) as pool:
+            workers = [pool.submit(stage_worker, i) for i in range(len(self.stages))]
+            pool.submit(feed_sources)
+
+            outputs = []
+            while True:
+                output = queues[-1].get()
+                if output is eof:
+                    break
+
+                outputs.append(output)
+
+            # re-raise any errors from the stage workers
+            for worker in workers:
+                worker.result()
+
+        return outputs
+
     def __call__(
         self,
         job: WorkerContext,
@@ -108,97 +390,19 @@ class ChainPipeline:
             sources = [None]
             logger.info("running pipeline without source images")
 
-        stage_sources = sources
-        for stage_pipe, stage_params, stage_kwargs in self.stages:
-            name = stage_params.name or stage_pipe.__class__.__name__
-            kwargs = stage_kwargs or {}
-            kwargs = {**pipeline_kwargs, **kwargs}
-            logger.debug(
-                "running stage %s with %s source images, parameters: %s",
-                name,
-                len(stage_sources) - stage_sources.count(None),
-                kwargs.keys(),
+        if len(self.stages) > 1 and len(sources) > 1:
+            # with multiple sources, each stage can run on the next image while the following
+            # stage consumes its last result, letting CPU-bound and GPU-bound stages overlap
+            stage_sources = self.run_parallel(
+                job, server, params, sources, callback, pipeline_kwargs
             )
-
-            # the stage must be split and tiled if any image is larger than the selected/max tile size
-            must_tile = any(
-                [
-                    needs_tile(
-                        stage_pipe.max_tile,
-                        stage_params.tile_size,
-                        size=kwargs.get("size", None),
-                        source=source,
-                    )
-                    for source in stage_sources
-                ]
-            )
-
-            tile = stage_params.tile_size
-            if stage_pipe.max_tile > 0:
-                tile = min(stage_pipe.max_tile, stage_params.tile_size)
-
-            if must_tile:
-                stage_outputs = []
-                for source in stage_sources:
-                    logger.info(
-                        "image larger than tile size of %s, tiling stage",
-                        tile,
-                    )
-
-                    def stage_tile(
-                        source_tile: Image.Image,
-                        tile_mask: Image.Image,
-                        dims: Tuple[int, int, int],
-                    ) -> Image.Image:
-                        output_tile = stage_pipe.run(
-                            job,
-                            server,
-                            stage_params,
-                            params,
-                            [source_tile],
-                            tile_mask=tile_mask,
-                            callback=callback,
-                            dims=dims,
-                            **kwargs,
-                        )[0]
-
-                        if is_debug():
-                            save_image(server, "last-tile.png", output_tile)
-
-                        return output_tile
-
-                    output = process_tile_order(
-                        stage_params.tile_order,
-                        source,
-                        tile,
-                        stage_params.outscale,
-                        [stage_tile],
-                        **kwargs,
-                    )
-                    stage_outputs.append(output)
-
-                stage_sources = stage_outputs
-            else:
-                logger.debug("image within tile size of %s, running stage", tile)
-                stage_sources = stage_pipe.run(
-                    job,
-                    server,
-                    stage_params,
-                    params,
-                    stage_sources,
-                    callback=callback,
-                    **kwargs,
+        else:
+            stage_sources = sources
+            for stage in self.stages:
+                stage_sources = self.run_stage(
+                    job, server, params, stage, stage_sources, callback, pipeline_kwargs
                 )
 
-            logger.debug(
-                "finished stage %s with %s results",
-                name,
-                len(stage_sources),
-            )
-
-            if is_debug():
-                save_image(server, "last-stage.png", stage_sources[0])
-
         end = monotonic()
         duration = timedelta(seconds=(end - start))
         logger.info(
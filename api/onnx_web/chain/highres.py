@@ -30,6 +30,12 @@ def stage_highres(
         logger.debug("no highres iterations, skipping")
         return chain
 
+    if highres.scale <= 1:
+        # the upscale stage would skip itself at this scale, but the blend stage would
+        # still run a full img2img pass over the unchanged image
+        logger.debug("highres scale of %s is a no-op, skipping", highres.scale)
+        return chain
+
     for _i in range(highres.iterations):
         if highres.method == "upscale":
             logger.debug("using upscaling pipeline for highres")
@@ -1,8 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from logging import getLogger
-from typing import List, Optional
+from os import path
+from threading import Lock, local
+from typing import Any, Dict, List, Optional, Tuple
 
 from boto3 import Session
+from boto3.s3.transfer import TransferConfig
 from PIL import Image
 
 from ..params import ImageParams, StageParams
@@ -12,6 +16,66 @@ from .stage import BaseStage
 
 logger = getLogger(__name__)
 
+# clients are thread-safe and expensive to build, so cache one per profile/endpoint
+s3_clients: Dict[Tuple[Optional[str], Optional[str]], Any] = {}
+s3_clients_lock = Lock()
+
+transfer_config = TransferConfig(
+    multipart_threshold=(8 * 1024 * 1024), use_threads=True
+)
+
+thread_buffers = local()
+
+
+def get_client(profile_name: Optional[str], endpoint_url: Optional[str]):
+    key = (profile_name, endpoint_url)
+    with s3_clients_lock:
+        client = s3_clients.get(key)
+        if client is None:
+            logger.debug("creating new S3 client for %s", key)
+            session = Session(profile_name=profile_name)
+            client = session.client("s3", endpoint_url=endpoint_url)
+            s3_clients[key] = client
+
+    return client
+
+
+def get_upload_format(output: str, default: str) -> str:
+    """
+    Pick the image format for an upload from the destination extension, falling back
+    to the server's default format.
+    """
+    ext = path.splitext(output)[1].lower().lstrip(".")
+    if ext in ("png", "webp", "jpg", "jpeg"):
+        return "jpeg" if ext == "jpg" else ext
+
+    return default
+
+
+def save_source(source: Image.Image, data: BytesIO, format: str) -> None:
+    if format == "png":
+        # the network is usually the bottleneck, so prefer a fast encode to a small file
+        source.save(data, format=format, compress_level=1)
+    elif format == "webp":
+        source.save(data, format=format, quality=90, method=4)
+    else:
+        source.save(data, format=format)
+
+
+def get_buffer() -> BytesIO:
+    """
+    Reuse a single encoding buffer per thread rather than allocating one per image.
+    """
+    data = getattr(thread_buffers, "data", None)
+    if data is None:
+        data = BytesIO()
+        thread_buffers.data = data
+    else:
+        data.seek(0)
+        data.truncate()
+
+    return data
+
 
 class PersistS3Stage(BaseStage):
     def run(
@@ -29,18 +93,30 @@ class PersistS3Stage(BaseStage):
         stage_source: Optional[Image.Image] = None,
         **kwargs,
     ) -> List[Image.Image]:
-        session = Session(profile_name=profile_name)
-        s3 = session.client("s3", endpoint_url=endpoint_url)
+        s3 = get_client(profile_name, endpoint_url)
 
-        for source in sources:
-            data = BytesIO()
-            source.save(data, format=server.image_format)
+        format = get_upload_format(output, server.image_format)
+
+        def upload_source(source: Image.Image) -> None:
+            data = get_buffer()
+            save_source(source, data, format)
             data.seek(0)
 
             try:
-                s3.upload_fileobj(data, bucket, output)
+                s3.upload_fileobj(data, bucket, output, Config=transfer_config)
                 logger.info("saved image to s3://%s/%s", bucket, output)
             except Exception:
                 logger.exception("error saving image to S3")
 
+        if len(sources) > 1:
+            # uploads are latency-bound, so encode and upload the sources concurrently
+            with ThreadPoolExecutor(max_workers=min(8, len(sources))) as pool:
+                for future in [
+                    pool.submit(upload_source, source) for source in sources
+                ]:
+                    future.result()
+        else:
+            for source in sources:
+                upload_source(source)
+
         return sources
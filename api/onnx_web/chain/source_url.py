@@ -1,9 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from logging import getLogger
 from typing import List
 
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
 
 from ..params import ImageParams, StageParams
 from ..server import ServerContext
@@ -12,6 +14,22 @@ from .stage import BaseStage
 
 logger = getLogger(__name__)
 
+# shared session with keep-alive, so fetching many URLs from one host reuses connections
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+
+def fetch_source(url: str) -> Image.Image:
+    response = session.get(url, timeout=30)
+    output = Image.open(BytesIO(response.content))
+
+    # decode in the worker thread rather than lazily on first use
+    output.load()
+
+    logger.info("final output image size: %sx%s", output.width, output.height)
+    return output
+
 
 class SourceURLStage(BaseStage):
     def run(
@@ -33,12 +51,10 @@ class SourceURLStage(BaseStage):
                 "a source image was passed to a source stage, and will be discarded"
             )
 
-        outputs = []
-        for url in source_urls:
-            response = requests.get(url)
-            output = Image.open(BytesIO(response.content))
-
-            logger.info("final output image size: %sx%s", output.width, output.height)
-            outputs.append(output)
+        if len(source_urls) > 1:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                outputs = list(pool.map(fetch_source, source_urls))
+        else:
+            outputs = [fetch_source(url) for url in source_urls]
 
         return outputs
@@ -10,6 +10,10 @@ from ..worker.context import WorkerContext
 class BaseStage:
     max_tile = SizeChart.auto
 
+    # when True, images that barely overflow the tile size are resized to fit a single
+    # tile instead of being split; not safe for mask-sensitive stages like inpainting
+    resize_fast_path = False
+
     def run(
         self,
         job: WorkerContext,
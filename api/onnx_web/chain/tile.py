@@ -60,6 +60,17 @@ def needs_tile(
     return False
 
 
+def choose_tile_size(dim: int, target: int) -> int:
+    """
+    Choose the smallest tile size that covers the dimension with the same number of tiles
+    as the target size, so borderline images do not produce tiny sliver tiles.
+
+    The result is rounded up to a multiple of 8 to stay compatible with latent sizes.
+    """
+    count = max(1, ceil(dim / target))
+    return ceil(dim / (count * 8)) * 8
+
+
 def get_tile_grads(
     left: int,
     top: int,
@@ -99,12 +110,12 @@ def blend_tiles(
     )
 
     scaled_size = (height * scale, width * scale, 3)
-    count = np.zeros(scaled_size)
-    value = np.zeros(scaled_size)
+    count = np.zeros(scaled_size, dtype=np.float32)
+    value = np.zeros(scaled_size, dtype=np.float32)
 
     for left, top, tile_image in tiles:
         # histogram equalization
-        equalized = np.array(tile_image).astype(np.float32)
+        equalized = np.asarray(tile_image, dtype=np.float32)
         mask = np.ones_like(equalized[:, :, 0])
 
         if adj_tile < tile:
@@ -117,12 +128,14 @@ def blend_tiles(
             grad_x, grad_y = get_tile_grads(left, top, adj_tile, width, height)
             logger.debug("tile gradients: %s, %s, %s", points, grad_x, grad_y)
 
-            mult_x = [np.interp(i, points, grad_x) for i in range(tile * scale)]
-            mult_y = [np.interp(i, points, grad_y) for i in range(tile * scale)]
+            # ease the linear ramps with a sin^2 curve, which keeps the weights
+            # normalized but removes the visible seams left by hard linear edges
+            steps = np.arange(tile * scale)
+            mult_x = np.sin(np.interp(steps, points, grad_x) * np.pi / 2) ** 2
+            mult_y = np.sin(np.interp(steps, points, grad_y) * np.pi / 2) ** 2
 
             mask = ((mask * mult_x).T * mult_y).T
-            for c in range(3):
-                equalized[:, :, c] = equalized[:, :, c] * mask
+            equalized = equalized * mask[:, :, np.newaxis]
 
         scaled_top = top * scale
         scaled_left = left * scale
@@ -161,64 +174,74 @@ def blend_tiles(
             margin_left : equalized.shape[1] + margin_right,
             :,
         ]
-        count[
-            writable_top:writable_bottom, writable_left:writable_right, :
-        ] += np.repeat(
-            mask[
-                margin_top : equalized.shape[0] + margin_bottom,
-                margin_left : equalized.shape[1] + margin_right,
-                np.newaxis,
-            ],
-            3,
-            axis=2,
-        )
+        # broadcast the mask across the channels rather than repeating it in memory
+        count[writable_top:writable_bottom, writable_left:writable_right, :] += mask[
+            margin_top : equalized.shape[0] + margin_bottom,
+            margin_left : equalized.shape[1] + margin_right,
+            np.newaxis,
+        ]
 
     logger.trace("mean tiles contributing to each pixel: %s", np.mean(count))
     pixels = np.where(count > 0, value / count, value)
     return Image.fromarray(np.uint8(pixels))
 
 
-def process_tile_grid(
-    source: Image.Image,
+def plan_tile_grid(
+    width: int,
+    height: int,
     tile: int,
-    scale: int,
-    filters: List[TileCallback],
     overlap: float = 0.0,
-    **kwargs,
-) -> Image.Image:
-    width, height = kwargs.get("size", source.size if source else None)
-
+) -> List[Tuple[int, int]]:
+    """
+    Generate the tile coordinates for a grid pass, so the schedule can be planned once
+    and reused across similar images.
+    """
     adj_tile = int(float(tile) * (1.0 - overlap))
     tiles_x = ceil(width / adj_tile)
     tiles_y = ceil(height / adj_tile)
-    total = tiles_x * tiles_y
     logger.debug(
-        "processing %s tiles (%s x %s) with adjusted size of %s, %s overlap",
-        total,
+        "planning %s tiles (%s x %s) with adjusted size of %s, %s overlap",
+        tiles_x * tiles_y,
         tiles_x,
         tiles_y,
         adj_tile,
         overlap,
     )
 
+    return [
+        (x * adj_tile, y * adj_tile) for y in range(tiles_y) for x in range(tiles_x)
+    ]
+
+
+def process_tile_grid(
+    source: Image.Image,
+    tile: int,
+    scale: int,
+    filters: List[TileCallback],
+    overlap: float = 0.0,
+    tile_coords: Optional[List[Tuple[int, int]]] = None,
+    **kwargs,
+) -> Image.Image:
+    width, height = kwargs.get("size", source.size if source else None)
+
+    if tile_coords is None:
+        tile_coords = plan_tile_grid(width, height, tile, overlap=overlap)
+
+    total = len(tile_coords)
     tiles: List[Tuple[int, int, Image.Image]] = []
 
-    for y in range(tiles_y):
-        for x in range(tiles_x):
-            idx = (y * tiles_x) + x
-            left = x * adj_tile
-            top = y * adj_tile
-            logger.info("processing tile %s of %s, %s.%s", idx + 1, total, y, x)
+    for idx, (left, top) in enumerate(tile_coords):
+        logger.info("processing tile %s of %s, %sx%s", idx + 1, total, left, top)
 
-            tile_image = (
-                source.crop((left, top, left + tile, top + tile)) if source else None
-            )
-            tile_image = complete_tile(tile_image, tile)
+        tile_image = (
+            source.crop((left, top, left + tile, top + tile)) if source else None
+        )
+        tile_image = complete_tile(tile_image, tile)
 
-            for filter in filters:
-                tile_image = filter(tile_image, (left, top, tile))
+        for filter in filters:
+            tile_image = filter(tile_image, (left, top, tile))
 
-            tiles.append((left, top, tile_image))
+        tiles.append((left, top, tile_image))
 
     return blend_tiles(tiles, scale, width, height, tile, overlap)
 
@@ -229,6 +252,7 @@ def process_tile_spiral(
     scale: int,
     filters: List[TileCallback],
     overlap: float = 0.5,
+    tile_coords: Optional[List[Tuple[int, int]]] = None,
     **kwargs,
 ) -> Image.Image:
     width, height = kwargs.get("size", source.size if source else None)
@@ -237,12 +261,18 @@ def process_tile_spiral(
     fill_color = kwargs.get("fill_color", None)
     if not mask:
         tile_mask = None
+        mask_np = None
+    else:
+        # keep the mask in a single contiguous array, so the per-tile masks are numpy
+        # slices instead of PIL crop and paste round-trips
+        mask_np = np.asarray(mask.convert("L"))
 
     tiles: List[Tuple[int, int, Image.Image]] = []
 
     # tile tuples is source, multiply by scale for dest
     counter = 0
-    tile_coords = generate_tile_spiral(width, height, tile, overlap=overlap)
+    if tile_coords is None:
+        tile_coords = generate_tile_spiral(width, height, tile, overlap=overlap)
 
     if len(tile_coords) == 1:
         single_tile = True
@@ -307,22 +337,22 @@ def process_tile_spiral(
                 tile_image.paste(base_image, (left_margin, top_margin))
 
                 if mask:
-                    base_mask = mask.crop(
-                        (
-                            left + left_margin,
-                            top + top_margin,
-                            right + right_margin,
-                            bottom + bottom_margin,
-                        )
-                    )
-                    tile_mask = Image.new("L", (tile, tile), color=0)
-                    tile_mask.paste(base_mask, (left_margin, top_margin))
+                    base_mask = mask_np[
+                        top + top_margin : bottom + bottom_margin,
+                        left + left_margin : right + right_margin,
+                    ]
+                    tile_mask_np = np.zeros((tile, tile), dtype=np.uint8)
+                    tile_mask_np[
+                        top_margin : top_margin + base_mask.shape[0],
+                        left_margin : left_margin + base_mask.shape[1],
+                    ] = base_mask
+                    tile_mask = Image.fromarray(tile_mask_np)
 
         else:
             logger.debug("tiling normally")
             tile_image = source.crop((left, top, right, bottom))
             if mask:
-                tile_mask = mask.crop((left, top, right, bottom))
+                tile_mask = Image.fromarray(mask_np[top:bottom, left:right])
 
         for image_filter in filters:
             tile_image = image_filter(tile_image, tile_mask, (left, top, tile))
@@ -17,6 +17,7 @@ logger = getLogger(__name__)
 
 class UpscaleBSRGANStage(BaseStage):
     max_tile = 64
+    resize_fast_path = True
 
     def load(
         self,
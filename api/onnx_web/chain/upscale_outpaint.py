@@ -13,10 +13,9 @@ from ..diffusers.utils import (
     parse_prompt,
 )
 from ..image import mask_filter_none, noise_source_histogram
-from ..output import save_image
+from ..output import save_debug_image
 from ..params import Border, ImageParams, Size, SizeChart, StageParams
 from ..server import ServerContext
-from ..utils import is_debug
 from ..worker import ProgressCallback, WorkerContext
 from .stage import BaseStage
 
@@ -26,6 +25,47 @@ logger = getLogger(__name__)
 class UpscaleOutpaintStage(BaseStage):
     max_tile = SizeChart.unlimited
 
+    def __init__(self) -> None:
+        self.pipe = None
+        self.pipe_key = None
+
+        # tile latents sliced from the full set, keyed by seed, size, and tile dims
+        self.latent_cache = {}
+
+    def load(
+        self,
+        server: ServerContext,
+        params: ImageParams,
+        pipe_type: str,
+        device,
+        inversions,
+        loras,
+    ):
+        """
+        Load the inpaint pipeline once per outpaint run, so the per-tile calls skip the
+        pipeline cache lookup and cannot trigger a reload mid-image.
+        """
+        key = (
+            pipe_type,
+            params.model,
+            params.scheduler,
+            device.device,
+            tuple(inversions),
+            tuple(loras),
+        )
+        if self.pipe is None or self.pipe_key != key:
+            self.pipe = load_pipeline(
+                server,
+                params,
+                pipe_type,
+                device,
+                inversions=inversions,
+                loras=loras,
+            )
+            self.pipe_key = key
+
+        return self.pipe
+
     def run(
         self,
         job: WorkerContext,
@@ -51,20 +91,12 @@ class UpscaleOutpaintStage(BaseStage):
         )
 
         pipe_type = params.get_valid_pipeline("inpaint", params.pipeline)
-        pipe = load_pipeline(
-            server,
-            params,
-            pipe_type,
-            job.get_device(),
-            inversions=inversions,
-            loras=loras,
-        )
+        pipe = self.load(server, params, pipe_type, job.get_device(), inversions, loras)
 
         outputs = []
         for source in sources:
-            if is_debug():
-                save_image(server, "tile-source.png", source)
-                save_image(server, "tile-mask.png", tile_mask)
+            save_debug_image(server, "tile-source.png", source)
+            save_debug_image(server, "tile-mask.png", tile_mask)
 
             # if the tile mask is all black, skip processing this tile
             if not tile_mask.getbbox():
@@ -75,11 +107,21 @@ class UpscaleOutpaintStage(BaseStage):
             size = Size(*source.size)
             latent_size = size.min(tile_size, tile_size)
 
-            # generate new latents or slice existing
-            if latents is None:
-                latents = get_latents_from_seed(params.seed, latent_size, params.batch)
-            else:
-                latents = get_tile_latents(latents, params.seed, latent_size, dims)
+            # generate new latents or slice existing, caching the slice so repeat tiles
+            # reuse it rather than cutting the full latents again
+            latent_key = (params.seed, latent_size.width, latent_size.height, dims)
+            tile_latents = self.latent_cache.get(latent_key)
+            if tile_latents is None:
+                if latents is None:
+                    tile_latents = get_latents_from_seed(
+                        params.seed, latent_size, params.batch
+                    )
+                else:
+                    tile_latents = get_tile_latents(
+                        latents, params.seed, latent_size, dims
+                    )
+
+                self.latent_cache[latent_key] = tile_latents
 
             if params.lpw():
                 logger.debug("using LPW pipeline for inpaint")
@@ -94,7 +136,7 @@ class UpscaleOutpaintStage(BaseStage):
                     num_inference_steps=params.steps,
                     guidance_scale=params.cfg,
                     generator=rng,
-                    latents=latents,
+                    latents=tile_latents,
                     callback=callback,
                 )
             else:
@@ -115,7 +157,7 @@ class UpscaleOutpaintStage(BaseStage):
                     num_inference_steps=params.steps,
                     guidance_scale=params.cfg,
                     generator=rng,
-                    latents=latents,
+                    latents=tile_latents,
                     callback=callback,
                 )
 
@@ -18,6 +18,8 @@ TAG_X4_V3 = "real-esrgan-x4-v3"
 
 
 class UpscaleRealESRGANStage(BaseStage):
+    resize_fast_path = True
+
     def load(
         self, server: ServerContext, params: UpscaleParams, device: DeviceParams, tile=0
     ):
@@ -28,7 +30,17 @@ class UpscaleRealESRGANStage(BaseStage):
         model_file = "%s.%s" % (params.upscale_model, params.format)
         model_path = path.join(server.model_path, model_file)
 
-        cache_key = (model_path, params.format)
+        # the cache key must cover every param that changes the constructed pipeline,
+        # so alternating models or denoise levels does not reuse a stale instance
+        cache_key = (
+            model_path,
+            params.format,
+            params.scale,
+            params.denoise,
+            params.tile_pad,
+            params.pre_pad,
+            tile,
+        )
         cache_pipe = server.cache.get(ModelTypes.upscaling, cache_key)
         if cache_pipe is not None:
             logger.info("reusing existing Real ESRGAN pipeline")
@@ -85,16 +97,26 @@ class UpscaleRealESRGANStage(BaseStage):
     ) -> List[Image.Image]:
         logger.info("upscaling image with Real ESRGAN: x%s", upscale.scale)
 
-        outputs = []
-        for source in sources:
-            output = np.array(source)
-            upsampler = self.load(
-                server, upscale, job.get_device(), tile=stage.tile_size
-            )
+        upsampler = self.load(server, upscale, job.get_device(), tile=stage.tile_size)
 
-            output, _ = upsampler.enhance(output, outscale=upscale.outscale)
+        # convert the sources up front so the enhance loop only runs the model;
+        # asarray returns a view of the image buffer when the mode already matches,
+        # avoiding the copy that np.array always makes
+        inputs = [np.asarray(source.convert("RGB")) for source in sources]
 
-            output = Image.fromarray(output, "RGB")
+        results = []
+        for source in inputs:
+            output, _ = upsampler.enhance(source, outscale=upscale.outscale)
+            results.append(output)
+
+        outputs = []
+        for output in results:
+            if not output.flags["C_CONTIGUOUS"]:
+                output = np.ascontiguousarray(output)
+
+            output = Image.frombuffer(
+                "RGB", (output.shape[1], output.shape[0]), output, "raw", "RGB", 0, 1
+            )
             logger.info("final output image size: %sx%s", output.width, output.height)
             outputs.append(output)
 
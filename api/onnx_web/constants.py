@@ -1,2 +1,3 @@
 ONNX_MODEL = "model.onnx"
+ONNX_MODEL_INT8 = "model-int8.onnx"
 ONNX_WEIGHTS = "weights.pb"
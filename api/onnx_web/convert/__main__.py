@@ -578,6 +578,24 @@ def main(args=None) -> int:
         type=int,
         help="The version of the ONNX operator set to use.",
     )
+    parser.add_argument(
+        "--dynamo",
+        action="store_true",
+        default=False,
+        help="Export the UNet with the dynamo exporter, requires torch 2.6+.",
+    )
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        default=False,
+        help="Export int8 quantized variants of diffusion models, faster on VNNI CPUs.",
+    )
+    parser.add_argument(
+        "--optimize",
+        action="store_true",
+        default=False,
+        help="Run the ORT graph optimizer on exported models, faster to load later.",
+    )
     parser.add_argument(
         "--token",
         type=str,
@@ -590,6 +608,9 @@ def main(args=None) -> int:
     server = ConversionContext.from_environ()
     server.half = args.half or "onnx-fp16" in server.optimizations
     server.opset = args.opset
+    server.dynamo = args.dynamo or server.dynamo
+    server.int8 = args.int8 or server.int8
+    server.optimize = args.optimize or server.optimize
     server.token = args.token
     logger.info(
         "converting models in %s using %s", server.model_path, server.training_device
@@ -5,7 +5,12 @@ import torch
 from torch.onnx import export
 
 from ...models.rrdb import RRDBNet
-from ..utils import ConversionContext, ModelDict
+from ..utils import (
+    ConversionContext,
+    ModelDict,
+    check_converted_model,
+    save_converted_model_meta,
+)
 
 logger = getLogger(__name__)
 
@@ -23,7 +28,7 @@ def convert_correction_gfpgan(
     dest = path.join(conversion.model_path, name + ".onnx")
     logger.info("converting GFPGAN model: %s -> %s", name, dest)
 
-    if path.isfile(dest):
+    if check_converted_model(conversion, dest):
         logger.info("ONNX model already exists, skipping")
         return
 
@@ -66,4 +71,5 @@ def convert_correction_gfpgan(
         opset_version=conversion.opset,
         export_params=True,
     )
+    save_converted_model_meta(conversion, dest)
     logger.info("GFPGAN exported to ONNX successfully")
@@ -9,12 +9,17 @@
 #   https://github.com/huggingface/diffusers/blob/main/LICENSE
 ###
 
+from concurrent.futures import ProcessPoolExecutor, wait
+from functools import partial
 from logging import getLogger
+from multiprocessing import get_context
 from os import mkdir, path
 from pathlib import Path
 from shutil import rmtree
-from typing import Any, Dict, Optional, Tuple, Union
+from tempfile import mkdtemp
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from diffusers import (
     AutoencoderKL,
@@ -29,14 +34,24 @@ from diffusers.pipelines.stable_diffusion.convert_from_ckpt import (
     download_from_original_stable_diffusion_ckpt,
 )
 from onnx import load_model, save_model
+from onnx.checker import check_model
 
-from ...constants import ONNX_MODEL, ONNX_WEIGHTS
+from ...constants import ONNX_MODEL, ONNX_MODEL_INT8, ONNX_WEIGHTS
 from ...diffusers.load import optimize_pipeline
 from ...diffusers.pipelines.upscale import OnnxStableDiffusionUpscalePipeline
 from ...diffusers.version_safe_diffusers import AttnProcessor
 from ...models.cnet import UNet2DConditionModel_CNet
 from ...utils import run_gc
-from ..utils import ConversionContext, is_torch_2_0, load_tensor, onnx_export
+from ..utils import (
+    ConversionContext,
+    free_training_memory,
+    has_dynamo_export,
+    is_torch_2_0,
+    load_tensor,
+    onnx_export,
+    onnx_optimize,
+    onnx_quantize,
+)
 from .checkpoint import convert_extract_checkpoint
 
 logger = getLogger(__name__)
@@ -101,6 +116,79 @@ def get_model_version(
     return (v2, opts)
 
 
+def make_unet_dummy_tensors(
+    device: str,
+    dtype,
+    unet_in_channels: int,
+    unet_sample_size: int,
+    num_tokens: int,
+    text_hidden_size: int,
+) -> Dict[str, Any]:
+    """
+    Allocate the tracing tensors shared by the UNet and CNet exports once. These are
+    the largest device allocations made during conversion, so they are reused across
+    passes and freed as soon as both exports are done.
+    """
+    return {
+        "sample": torch.randn(
+            2, unet_in_channels, unet_sample_size, unet_sample_size
+        ).to(device=device, dtype=dtype),
+        "timestep": torch.randn(2).to(device=device, dtype=dtype),
+        "hidden": torch.randn(2, num_tokens, text_hidden_size).to(
+            device=device, dtype=dtype
+        ),
+    }
+
+
+def vae_encoder_forward(vae, sample, return_dict):
+    # need to get the raw tensor output (sample) from the encoder
+    return vae.encode(sample, return_dict)[0].sample()
+
+
+@torch.no_grad()
+def export_submodel(
+    module_file: str,
+    forward_patch: Optional[str],
+    model_args: tuple,
+    output_path: str,
+    ordered_input_names: List[str],
+    output_names: List[str],
+    dynamic_axes: Dict[str, Dict[int, str]],
+    opset: int,
+    half: bool,
+    dynamo: bool = False,
+) -> None:
+    """
+    Export one submodel from a worker process. torch.onnx.export is not thread-safe
+    and the GIL blocks overlapping the disk-heavy exports, so everything except the
+    UNet runs in subprocesses on the CPU while the UNet keeps the training device.
+    """
+    # the file holds a pickled module written by the parent process moments
+    # earlier, so it is trusted input; torch 2.6 flipped weights_only to True
+    model = torch.load(module_file, map_location="cpu", weights_only=False).to(
+        dtype=torch.float32
+    )
+    model.eval()
+
+    if forward_patch == "vae_encoder":
+        model.forward = partial(vae_encoder_forward, model)
+    elif forward_patch == "vae_decoder":
+        # forward only through the decoder part
+        model.forward = model.decode
+
+    onnx_export(
+        model,
+        model_args=model_args,
+        output_path=Path(output_path),
+        ordered_input_names=ordered_input_names,
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        opset=opset,
+        half=half,
+        dynamo=dynamo,
+    )
+
+
 @torch.no_grad()
 def convert_diffusion_diffusers_cnet(
     conversion: ConversionContext,
@@ -114,8 +202,19 @@ def convert_diffusion_diffusers_cnet(
     text_hidden_size,
     unet: Optional[Any] = None,
     v2: Optional[bool] = False,
+    dummy: Optional[Dict[str, Any]] = None,
 ):
     # CNet
+    if dummy is None:
+        dummy = make_unet_dummy_tensors(
+            device,
+            dtype,
+            unet_in_channels,
+            unet_sample_size,
+            num_tokens,
+            text_hidden_size,
+        )
+
     if unet is not None:
         logger.debug("creating CNet from existing UNet config")
         pipe_cnet = UNet2DConditionModel_CNet.from_config(unet.config)
@@ -135,11 +234,9 @@ def convert_diffusion_diffusers_cnet(
     onnx_export(
         pipe_cnet,
         model_args=(
-            torch.randn(2, unet_in_channels, unet_sample_size, unet_sample_size).to(
-                device=device, dtype=dtype
-            ),
-            torch.randn(2).to(device=device, dtype=dtype),
-            torch.randn(2, num_tokens, text_hidden_size).to(device=device, dtype=dtype),
+            dummy["sample"],
+            dummy["timestep"],
+            dummy["hidden"],
             torch.randn(2, 320, unet_sample_size, unet_sample_size).to(
                 device=device, dtype=dtype
             ),
@@ -388,31 +485,51 @@ def convert_diffusion_diffusers(
         return_tensors="pt",
     )
 
+    # the independent submodels export in subprocesses, overlapping their disk-heavy
+    # work with the GPU-heavy UNet export in the main process
+    export_pool = None
+    export_futures = []
+    export_temp = None
+
+    encoder_path = output_path / "text_encoder" / ONNX_MODEL
     if not cnet_only:
-        encoder_path = output_path / "text_encoder" / ONNX_MODEL
+        export_pool = ProcessPoolExecutor(
+            max_workers=2, mp_context=get_context("spawn")
+        )
+        export_temp = mkdtemp(prefix="onnx-web-convert-")
+
+        encoder_temp = path.join(export_temp, "text_encoder.pt")
+        torch.save(pipeline.text_encoder, encoder_temp)
+
         logger.info("exporting text encoder to %s", encoder_path)
-        onnx_export(
-            pipeline.text_encoder,
-            # casting to torch.int32 until the CLIP fix is released: https://github.com/huggingface/transformers/pull/18515/files
-            model_args=(
-                text_input.input_ids.to(device=device, dtype=torch.int32),
-                None,  # attention mask
-                None,  # position ids
-                None,  # output attentions
-                torch.tensor(True).to(device=device, dtype=torch.bool),
-            ),
-            output_path=encoder_path,
-            ordered_input_names=["input_ids"],
-            output_names=["last_hidden_state", "pooler_output", "hidden_states"],
-            dynamic_axes={
-                "input_ids": {0: "batch", 1: "sequence"},
-            },
-            opset=conversion.opset,
-            half=conversion.half,
+        export_futures.append(
+            export_pool.submit(
+                export_submodel,
+                encoder_temp,
+                None,
+                # casting to torch.int32 until the CLIP fix is released: https://github.com/huggingface/transformers/pull/18515/files
+                (
+                    text_input.input_ids.to(dtype=torch.int32),
+                    None,  # attention mask
+                    None,  # position ids
+                    None,  # output attentions
+                    torch.tensor(True, dtype=torch.bool),
+                ),
+                str(encoder_path.absolute().as_posix()),
+                ["input_ids"],
+                ["last_hidden_state", "pooler_output", "hidden_states"],
+                {
+                    "input_ids": {0: "batch", 1: "sequence"},
+                },
+                conversion.opset,
+                conversion.half,
+                conversion.dynamo,
+            )
         )
 
     del pipeline.text_encoder
     run_gc()
+    free_training_memory(device)
 
     # UNET
     logger.debug("UNET config: %s", pipeline.unet.config)
@@ -430,18 +547,23 @@ def convert_diffusion_diffusers(
     unet_sample_size = pipeline.unet.config.sample_size
     unet_path = output_path / "unet" / ONNX_MODEL
 
+    dummy = make_unet_dummy_tensors(
+        device,
+        dtype,
+        unet_in_channels,
+        unet_sample_size,
+        num_tokens,
+        text_hidden_size,
+    )
+
     if not cnet_only:
         logger.info("exporting UNet to %s", unet_path)
         onnx_export(
             pipeline.unet,
             model_args=(
-                torch.randn(2, unet_in_channels, unet_sample_size, unet_sample_size).to(
-                    device=device, dtype=dtype
-                ),
-                torch.randn(2).to(device=device, dtype=dtype),
-                torch.randn(2, num_tokens, text_hidden_size).to(
-                    device=device, dtype=dtype
-                ),
+                dummy["sample"],
+                dummy["timestep"],
+                dummy["hidden"],
                 unet_scale,
             ),
             output_path=unet_path,
@@ -457,6 +579,7 @@ def convert_diffusion_diffusers(
             half=conversion.half,
             external_data=True,
             v2=v2,
+            dynamo=conversion.dynamo,
         )
 
     cnet_path = None
@@ -474,10 +597,12 @@ def convert_diffusion_diffusers(
             text_hidden_size,
             unet=pipeline.unet,
             v2=v2,
+            dummy=dummy,
         )
 
     del pipeline.unet
     run_gc()
+    free_training_memory(device)
 
     if conversion.control and not single_vae and not conversion.share_unet:
         cnet_source = torch_source or source
@@ -494,8 +619,14 @@ def convert_diffusion_diffusers(
             text_hidden_size,
             unet=None,
             v2=v2,
+            dummy=dummy,
         )
 
+    # the tracing tensors are no longer needed once the UNet and CNet are done
+    del dummy
+    run_gc()
+    free_training_memory(device)
+
     if cnet_path is not None:
         collate_cnet(cnet_path)
 
@@ -503,27 +634,59 @@ def convert_diffusion_diffusers(
         logger.info("done converting CNet")
         return (True, dest_path)
 
-    logger.debug("collating UNet external tensors")
     unet_model_path = str(unet_path.absolute().as_posix())
-    unet_dir = path.dirname(unet_model_path)
-    unet = load_model(unet_model_path)
 
-    # clean up existing tensor files
-    rmtree(unet_dir)
-    mkdir(unet_dir)
+    if not (conversion.dynamo and has_dynamo_export):
+        # the TorchScript exporter writes one file per tensor, so collate the
+        # external tensor files into one; dynamo already exports a single file
+        logger.debug("collating UNet external tensors")
+        unet_dir = path.dirname(unet_model_path)
+        unet = load_model(unet_model_path)
+
+        # clean up existing tensor files
+        rmtree(unet_dir)
+        mkdir(unet_dir)
+
+        save_model(
+            unet,
+            unet_model_path,
+            save_as_external_data=True,
+            all_tensors_to_one_file=True,
+            location=ONNX_WEIGHTS,
+            convert_attribute=False,
+        )
 
-    # collate external tensor files into one
-    save_model(
-        unet,
-        unet_model_path,
-        save_as_external_data=True,
-        all_tensors_to_one_file=True,
-        location=ONNX_WEIGHTS,
-        convert_attribute=False,
-    )
+        del unet
+        run_gc()
 
-    del unet
-    run_gc()
+    if conversion.optimize:
+        # fuse the attention ops now so sessions do not repeat it on every load
+        onnx_optimize(unet_model_path, "unet", external_data=True)
+
+    if conversion.int8:
+
+        def unet_calibration_inputs():
+            inputs = {
+                "sample": np.random.randn(
+                    1, unet_in_channels, unet_sample_size, unet_sample_size
+                ).astype(np.float32),
+                "timestep": np.random.uniform(0, 1000, size=(1,)).astype(np.float32),
+                "encoder_hidden_states": np.random.randn(
+                    1, num_tokens, text_hidden_size
+                ).astype(np.float32),
+            }
+            if single_vae:
+                inputs["class_labels"] = np.array([4], dtype=np.int64)
+            else:
+                inputs["return_dict"] = np.array(False)
+
+            return inputs
+
+        onnx_quantize(
+            unet_model_path,
+            str((output_path / "unet" / ONNX_MODEL_INT8).absolute().as_posix()),
+            unet_calibration_inputs,
+        )
 
     # VAE
     if replace_vae is not None:
@@ -538,92 +701,177 @@ def convert_diffusion_diffusers(
         pipeline.vae = vae
         run_gc()
 
+    # the VAE exports run on the CPU, so its device copy can be freed now
+    pipeline.vae = pipeline.vae.to("cpu")
+    free_training_memory(device)
+
+    # the encoder and decoder stay in separate files on purpose: they share no
+    # parameters (encoder/quant_conv vs decoder/post_quant_conv), the tracer
+    # specializes away a mode branch, and the pipelines only run one direction
+    # per call, so a fused graph saves neither disk nor session memory
+    vae_temp = path.join(export_temp, "vae.pt")
+    torch.save(pipeline.vae, vae_temp)
+
+    vae_only_path = output_path / "vae" / ONNX_MODEL
+    vae_encoder_path = output_path / "vae_encoder" / ONNX_MODEL
+    vae_decoder_path = output_path / "vae_decoder" / ONNX_MODEL
+
+    vae_latent_channels = pipeline.vae.config.latent_channels
+    vae_in_channels = pipeline.vae.config.in_channels
+    vae_sample_size = pipeline.vae.config.sample_size
+
     if single_vae:
         logger.debug("VAE config: %s", pipeline.vae.config)
 
         # SINGLE VAE
-        vae_only = pipeline.vae
-        vae_latent_channels = vae_only.config.latent_channels
-        # forward only through the decoder part
-        vae_only.forward = vae_only.decode
-
-        vae_path = output_path / "vae" / ONNX_MODEL
-        logger.info("exporting VAE to %s", vae_path)
-        onnx_export(
-            vae_only,
-            model_args=(
-                torch.randn(
-                    1, vae_latent_channels, unet_sample_size, unet_sample_size
-                ).to(device=device, dtype=dtype),
-                False,
-            ),
-            output_path=vae_path,
-            ordered_input_names=["latent_sample", "return_dict"],
-            output_names=["sample"],
-            dynamic_axes={
-                "latent_sample": {0: "batch", 1: "channels", 2: "height", 3: "width"},
-            },
-            opset=conversion.opset,
-            half=conversion.half,
+        logger.info("exporting VAE to %s", vae_only_path)
+        export_futures.append(
+            export_pool.submit(
+                export_submodel,
+                vae_temp,
+                "vae_decoder",
+                (
+                    torch.randn(
+                        1, vae_latent_channels, unet_sample_size, unet_sample_size
+                    ),
+                    False,
+                ),
+                str(vae_only_path.absolute().as_posix()),
+                ["latent_sample", "return_dict"],
+                ["sample"],
+                {
+                    "latent_sample": {
+                        0: "batch",
+                        1: "channels",
+                        2: "height",
+                        3: "width",
+                    },
+                },
+                conversion.opset,
+                conversion.half,
+                conversion.dynamo,
+            )
         )
     else:
         # VAE ENCODER
-        vae_encoder = pipeline.vae
-        vae_in_channels = vae_encoder.config.in_channels
-        vae_sample_size = vae_encoder.config.sample_size
-        # need to get the raw tensor output (sample) from the encoder
-        vae_encoder.forward = lambda sample, return_dict: vae_encoder.encode(
-            sample, return_dict
-        )[0].sample()
-
-        vae_path = output_path / "vae_encoder" / ONNX_MODEL
-        logger.info("exporting VAE encoder to %s", vae_path)
-        onnx_export(
-            vae_encoder,
-            model_args=(
-                torch.randn(1, vae_in_channels, vae_sample_size, vae_sample_size).to(
-                    device=device, dtype=dtype
+        logger.info("exporting VAE encoder to %s", vae_encoder_path)
+        export_futures.append(
+            export_pool.submit(
+                export_submodel,
+                vae_temp,
+                "vae_encoder",
+                (
+                    torch.randn(1, vae_in_channels, vae_sample_size, vae_sample_size),
+                    False,
                 ),
-                False,
-            ),
-            output_path=vae_path,
-            ordered_input_names=["sample", "return_dict"],
-            output_names=["latent_sample"],
-            dynamic_axes={
-                "sample": {0: "batch", 1: "channels", 2: "height", 3: "width"},
-            },
-            opset=conversion.opset,
-            half=False,  # https://github.com/ssube/onnx-web/issues/290
+                str(vae_encoder_path.absolute().as_posix()),
+                ["sample", "return_dict"],
+                ["latent_sample"],
+                {
+                    "sample": {0: "batch", 1: "channels", 2: "height", 3: "width"},
+                },
+                conversion.opset,
+                False,  # https://github.com/ssube/onnx-web/issues/290
+                conversion.dynamo,
+            )
         )
 
         # VAE DECODER
-        vae_decoder = pipeline.vae
-        vae_latent_channels = vae_decoder.config.latent_channels
-        # forward only through the decoder part
-        vae_decoder.forward = vae_encoder.decode
-
-        vae_path = output_path / "vae_decoder" / ONNX_MODEL
-        logger.info("exporting VAE decoder to %s", vae_path)
-        onnx_export(
-            vae_decoder,
-            model_args=(
-                torch.randn(
-                    1, vae_latent_channels, unet_sample_size, unet_sample_size
-                ).to(device=device, dtype=dtype),
-                False,
-            ),
-            output_path=vae_path,
-            ordered_input_names=["latent_sample", "return_dict"],
-            output_names=["sample"],
-            dynamic_axes={
-                "latent_sample": {0: "batch", 1: "channels", 2: "height", 3: "width"},
-            },
-            opset=conversion.opset,
-            half=conversion.half,
+        logger.info("exporting VAE decoder to %s", vae_decoder_path)
+        export_futures.append(
+            export_pool.submit(
+                export_submodel,
+                vae_temp,
+                "vae_decoder",
+                (
+                    torch.randn(
+                        1, vae_latent_channels, unet_sample_size, unet_sample_size
+                    ),
+                    False,
+                ),
+                str(vae_decoder_path.absolute().as_posix()),
+                ["latent_sample", "return_dict"],
+                ["sample"],
+                {
+                    "latent_sample": {
+                        0: "batch",
+                        1: "channels",
+                        2: "height",
+                        3: "width",
+                    },
+                },
+                conversion.opset,
+                conversion.half,
+                conversion.dynamo,
+            )
         )
 
     del pipeline.vae
     run_gc()
+    free_training_memory(device)
+
+    # the UNet is already collated, wait for the other submodels before running
+    # the post-export passes and building the output pipeline
+    logger.debug("waiting for submodel exports to complete")
+    wait(export_futures)
+    for future in export_futures:
+        future.result()
+
+    export_pool.shutdown()
+    rmtree(export_temp)
+
+    if conversion.optimize:
+        onnx_optimize(str(encoder_path.absolute().as_posix()), "clip")
+
+    if single_vae:
+        if conversion.optimize:
+            onnx_optimize(str(vae_only_path.absolute().as_posix()), "vae")
+
+        if conversion.int8:
+            onnx_quantize(
+                str(vae_only_path.absolute().as_posix()),
+                str((output_path / "vae" / ONNX_MODEL_INT8).absolute().as_posix()),
+                lambda: {
+                    "latent_sample": np.random.randn(
+                        1, vae_latent_channels, unet_sample_size, unet_sample_size
+                    ).astype(np.float32),
+                    "return_dict": np.array(False),
+                },
+            )
+    else:
+        if conversion.optimize:
+            onnx_optimize(str(vae_encoder_path.absolute().as_posix()), "vae")
+            onnx_optimize(str(vae_decoder_path.absolute().as_posix()), "vae")
+
+        if conversion.int8:
+            onnx_quantize(
+                str(vae_encoder_path.absolute().as_posix()),
+                str(
+                    (output_path / "vae_encoder" / ONNX_MODEL_INT8)
+                    .absolute()
+                    .as_posix()
+                ),
+                lambda: {
+                    "sample": np.random.randn(
+                        1, vae_in_channels, vae_sample_size, vae_sample_size
+                    ).astype(np.float32),
+                    "return_dict": np.array(False),
+                },
+            )
+            onnx_quantize(
+                str(vae_decoder_path.absolute().as_posix()),
+                str(
+                    (output_path / "vae_decoder" / ONNX_MODEL_INT8)
+                    .absolute()
+                    .as_posix()
+                ),
+                lambda: {
+                    "latent_sample": np.random.randn(
+                        1, vae_latent_channels, unet_sample_size, unet_sample_size
+                    ).astype(np.float32),
+                    "return_dict": np.array(False),
+                },
+            )
 
     if single_vae:
         logger.debug("reloading diffusion model with upscaling pipeline")
@@ -659,14 +907,14 @@ def convert_diffusion_diffusers(
     run_gc()
 
     if conversion.reload:
-        if single_vae:
-            _ = OnnxStableDiffusionUpscalePipeline.from_pretrained(
-                output_path, provider="CPUExecutionProvider"
-            )
-        else:
-            _ = OnnxStableDiffusionPipeline.from_pretrained(
-                output_path, provider="CPUExecutionProvider"
-            )
+        # a structural check on the UNet and a session for the much smaller
+        # text encoder catch broken exports without paying for a full UNet
+        # session, which needs several GB of arena on the CPU
+        logger.debug("verifying exported models")
+        check_model(unet_model_path)
+        _ = OnnxRuntimeModel.from_pretrained(
+            output_path / "text_encoder", provider="CPUExecutionProvider"
+        )
 
         logger.info("ONNX pipeline is loadable")
     else:
@@ -1,21 +1,25 @@
 from argparse import ArgumentParser
 from logging import getLogger
 from os import path
-from typing import Dict, List, Literal, Tuple, Union
+from typing import Dict, List, Literal, Optional, Tuple, Union
 
 import numpy as np
 import torch
 from onnx import ModelProto, load, numpy_helper
 from onnx.checker import check_model
 from onnx.external_data_helper import (
+    ExternalDataInfo,
     convert_model_to_external_data,
+    load_external_data_for_model,
     set_external_data,
+    uses_external_data,
     write_external_data_tensors,
 )
+from onnx.helper import tensor_dtype_to_np_dtype
 from onnxruntime import InferenceSession, OrtValue, SessionOptions
 
 from ...server.context import ServerContext
-from ..utils import ConversionContext, load_tensor
+from ..utils import ConversionContext, load_cached_tensor
 
 logger = getLogger(__name__)
 
@@ -45,6 +49,7 @@ def sum_weights(a: np.ndarray, b: np.ndarray) -> np.ndarray:
 
 def buffer_external_data_tensors(
     model: ModelProto,
+    base_dir: Optional[str] = None,
 ) -> Tuple[ModelProto, List[Tuple[str, OrtValue]]]:
     external_data = []
     for tensor in model.graph.initializer:
@@ -59,6 +64,19 @@ def buffer_external_data_tensors(
             set_external_data(tensor, location="foo.bin")
             tensor.name = name
             tensor.ClearField("raw_data")
+        elif base_dir is not None and uses_external_data(tensor):
+            # tensors that were not blended are still on disk, so they can be
+            # memory-mapped rather than copied into the session
+            info = ExternalDataInfo(tensor)
+            npt = np.memmap(
+                path.join(base_dir, info.location),
+                dtype=tensor_dtype_to_np_dtype(tensor.data_type),
+                mode="r",
+                offset=info.offset or 0,
+                shape=tuple(tensor.dims),
+            )
+            orv = OrtValue.ortvalue_from_numpy(npt)
+            external_data.append((name, orv))
 
     return (model, external_data)
 
@@ -85,7 +103,7 @@ def kernel_slice(x: int, y: int, shape: Tuple[int, int, int, int]) -> Tuple[int,
 
 
 def blend_loras(
-    _conversion: ServerContext,
+    server: ServerContext,
     base_name: Union[str, ModelProto],
     loras: List[Tuple[str, float]],
     model_type: Literal["text_encoder", "unet"],
@@ -94,8 +112,17 @@ def blend_loras(
     device = torch.device("cpu")
     dtype = torch.float32
 
-    base_model = base_name if isinstance(base_name, ModelProto) else load(base_name)
-    lora_models = [load_tensor(name, map_location=device) for name, _weight in loras]
+    if isinstance(base_name, ModelProto):
+        base_model = base_name
+        base_dir = ""
+    else:
+        # leave the external tensors on disk, so the ones that are not blended can be
+        # memory-mapped later rather than copied through the proto
+        base_model = load(base_name, load_external_data=False)
+        base_dir = path.dirname(base_name)
+    lora_models = [
+        load_cached_tensor(server, name, map_location=device) for name, _weight in loras
+    ]
 
     if model_type == "text_encoder":
         lora_prefix = "lora_te_"
@@ -364,7 +391,7 @@ def blend_loras(
             logger.trace("found weight initializer: %s", weight_node.name)
 
             # blending
-            onnx_weights = numpy_helper.to_array(weight_node)
+            onnx_weights = numpy_helper.to_array(weight_node, base_dir)
             logger.trace(
                 "found blended weights for conv: %s, %s",
                 onnx_weights.shape,
@@ -412,7 +439,7 @@ def blend_loras(
             logger.trace("found matmul initializer: %s", matmul_node.name)
 
             # blending
-            onnx_weights = numpy_helper.to_array(matmul_node)
+            onnx_weights = numpy_helper.to_array(matmul_node, base_dir)
             logger.trace(
                 "found blended weights for matmul: %s, %s",
                 weights.shape,
@@ -474,7 +501,9 @@ if __name__ == "__main__":
     )
     if args.dest is None or args.dest == "" or args.dest == ":load":
         # convert to external data and save to memory
-        (bare_model, external_data) = buffer_external_data_tensors(blend_model)
+        bare_model, external_data = buffer_external_data_tensors(
+            blend_model, path.dirname(args.base)
+        )
         logger.info("saved external data for %s nodes", len(external_data))
 
         external_names, external_values = zip(*external_data)
@@ -489,6 +518,8 @@ if __name__ == "__main__":
             "successfully loaded blended model: %s", [i.name for i in sess.get_inputs()]
         )
     else:
+        # read the unblended tensors back in before writing a standalone model
+        load_external_data_for_model(blend_model, path.dirname(args.base))
         convert_model_to_external_data(
             blend_model, all_tensors_to_one_file=True, location=f"lora-{args.type}.pb"
         )
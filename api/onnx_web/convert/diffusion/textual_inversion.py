@@ -9,7 +9,7 @@ from transformers import CLIPTokenizer
 
 from ...constants import ONNX_MODEL
 from ...server.context import ServerContext
-from ..utils import ConversionContext, load_tensor
+from ..utils import ConversionContext, load_cached_tensor
 
 logger = getLogger(__name__)
 
@@ -38,7 +38,7 @@ def blend_textual_inversions(
             base_token,
         )
 
-        loaded_embeds = load_tensor(name, map_location=device)
+        loaded_embeds = load_cached_tensor(server, name, map_location=device)
         if loaded_embeds is None:
             logger.warning("unable to load tensor")
             continue
@@ -5,7 +5,12 @@ import torch
 from torch.onnx import export
 
 from ...models.rrdb import RRDBNet
-from ..utils import ConversionContext, ModelDict
+from ..utils import (
+    ConversionContext,
+    ModelDict,
+    check_converted_model,
+    save_converted_model_meta,
+)
 
 logger = getLogger(__name__)
 
@@ -23,7 +28,7 @@ def convert_upscaling_bsrgan(
     dest = path.join(conversion.model_path, name + ".onnx")
     logger.info("converting BSRGAN model: %s -> %s", name, dest)
 
-    if path.isfile(dest):
+    if check_converted_model(conversion, dest):
         logger.info("ONNX model already exists, skipping")
         return
 
@@ -68,4 +73,5 @@ def convert_upscaling_bsrgan(
         opset_version=conversion.opset,
         export_params=True,
     )
+    save_converted_model_meta(conversion, dest)
     logger.info("BSRGAN exported to ONNX successfully")
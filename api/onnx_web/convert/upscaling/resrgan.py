@@ -5,7 +5,12 @@ import torch
 from torch.onnx import export
 
 from ...models.srvgg import SRVGGNetCompact
-from ..utils import ConversionContext, ModelDict
+from ..utils import (
+    ConversionContext,
+    ModelDict,
+    check_converted_model,
+    save_converted_model_meta,
+)
 
 logger = getLogger(__name__)
 
@@ -27,7 +32,7 @@ def convert_upscale_resrgan(
     dest = path.join(conversion.model_path, name + ".onnx")
     logger.info("converting Real ESRGAN model: %s -> %s", name, dest)
 
-    if path.isfile(dest):
+    if check_converted_model(conversion, dest):
         logger.info("ONNX model already exists, skipping")
         return
 
@@ -81,4 +86,5 @@ def convert_upscale_resrgan(
         opset_version=conversion.opset,
         export_params=True,
     )
+    save_converted_model_meta(conversion, dest)
     logger.info("real ESRGAN exported to ONNX successfully")
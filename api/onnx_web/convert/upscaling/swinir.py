@@ -5,7 +5,12 @@ import torch
 from torch.onnx import export
 
 from ...models.swinir import SwinIR
-from ..utils import ConversionContext, ModelDict
+from ..utils import (
+    ConversionContext,
+    ModelDict,
+    check_converted_model,
+    save_converted_model_meta,
+)
 
 logger = getLogger(__name__)
 
@@ -23,7 +28,7 @@ def convert_upscaling_swinir(
     dest = path.join(conversion.model_path, name + ".onnx")
     logger.info("converting SwinIR model: %s -> %s", name, dest)
 
-    if path.isfile(dest):
+    if check_converted_model(conversion, dest):
         logger.info("ONNX model already exists, skipping")
         return
 
@@ -113,4 +118,5 @@ def convert_upscaling_swinir(
         opset_version=conversion.opset,
         export_params=True,
     )
+    save_converted_model_meta(conversion, dest)
     logger.info("SwinIR exported to ONNX successfully")
@@ -1,9 +1,13 @@
+import gc
+import json
 import shutil
+from collections import OrderedDict
 from functools import partial
+from hashlib import sha256
 from logging import getLogger
 from os import environ, path
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import requests
 import safetensors
@@ -11,7 +15,14 @@ import torch
 from huggingface_hub.utils.tqdm import tqdm
 from onnx import load_model, save_model
 from onnx.shape_inference import infer_shapes_path
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_static,
+)
 from onnxruntime.transformers.float16 import convert_float_to_float16
+from onnxruntime.transformers.optimizer import optimize_model
 from packaging import version
 from torch.onnx import export
 
@@ -25,12 +36,35 @@ is_torch_2_0 = version.parse(
     version.parse(torch.__version__).base_version
 ) >= version.parse("2.0")
 
+# the dynamo exporter only honors input_names and dynamic_axes from 2.6 on
+is_torch_2_6 = version.parse(
+    version.parse(torch.__version__).base_version
+) >= version.parse("2.6")
+
+try:
+    # the dynamo exporter also lowers through onnxscript, which is optional
+    import onnxscript  # noqa: F401
+
+    has_dynamo_export = is_torch_2_6
+except ImportError:
+    has_dynamo_export = False
+
 
 ModelDict = Dict[str, Union[str, int]]
 LegacyModel = Tuple[str, str, Optional[bool], Optional[bool], Optional[int]]
 
 DEFAULT_OPSET = 14
 
+# ops without fp16 kernels on CPU, kept in fp32 so the converter hoists the casts
+# to the graph inputs and outputs rather than wrapping every node
+FP16_BLOCKED_OPS = [
+    "Erf",
+    "GroupNormalization",
+    "InstanceNormalization",
+    "LayerNormalization",
+    "Softmax",
+]
+
 
 class ConversionContext(ServerContext):
     def __init__(
@@ -46,14 +80,20 @@ class ConversionContext(ServerContext):
         reload: bool = True,
         share_unet: bool = True,
         extract: bool = False,
+        optimize: bool = False,
+        int8: bool = False,
+        dynamo: bool = False,
         **kwargs,
     ) -> None:
         super().__init__(model_path=model_path, cache_path=cache_path, **kwargs)
 
         self.control = control
+        self.dynamo = dynamo
         self.extract = extract
         self.half = half
+        self.int8 = int8
         self.opset = opset
+        self.optimize = optimize
         self.prune = prune or []
         self.reload = reload
         self.share_unet = share_unet
@@ -71,6 +111,9 @@ class ConversionContext(ServerContext):
         context.extract = get_boolean(environ, "ONNX_WEB_CONVERT_EXTRACT", True)
         context.reload = get_boolean(environ, "ONNX_WEB_CONVERT_RELOAD", True)
         context.share_unet = get_boolean(environ, "ONNX_WEB_CONVERT_SHARE_UNET", True)
+        context.dynamo = get_boolean(environ, "ONNX_WEB_CONVERT_DYNAMO", False)
+        context.int8 = get_boolean(environ, "ONNX_WEB_CONVERT_INT8", False)
+        context.optimize = get_boolean(environ, "ONNX_WEB_CONVERT_OPTIMIZE", False)
         context.opset = int(environ.get("ONNX_WEB_CONVERT_OPSET", DEFAULT_OPSET))
 
         cpu_only = get_boolean(environ, "ONNX_WEB_CONVERT_CPU_ONLY", False)
@@ -276,6 +319,39 @@ def load_tensor(name: str, map_location=None) -> Optional[Dict]:
     return checkpoint
 
 
+TENSOR_CACHE_LIMIT = 8
+
+tensor_cache = OrderedDict()
+
+
+def load_cached_tensor(
+    server: ServerContext, name: str, map_location=None
+) -> Optional[Dict]:
+    """
+    Load a blending tensor through a per-name cache, so hot LoRAs and Textual
+    Inversions are only read and parsed once across requests.
+
+    The shared ModelCache keeps a single entry per tag, which cannot hold the
+    several networks one blend uses, so the tensors get their own keyed cache
+    with its own limit.
+    """
+    if server.cache.limit == 0:
+        return load_tensor(name, map_location=map_location)
+
+    tensor = tensor_cache.get(name)
+    if tensor is not None:
+        tensor_cache.move_to_end(name)
+        logger.debug("reusing cached tensor: %s", name)
+        return tensor
+
+    tensor = load_tensor(name, map_location=map_location)
+    tensor_cache[name] = tensor
+    while len(tensor_cache) > TENSOR_CACHE_LIMIT:
+        tensor_cache.popitem(last=False)
+
+    return tensor
+
+
 def resolve_tensor(name: str) -> Optional[str]:
     logger.debug("searching for tensors with known extensions: %s", name)
     for next_extension in RESOLVE_FORMATS:
@@ -297,6 +373,7 @@ def onnx_export(
     half=False,
     external_data=False,
     v2=False,
+    dynamo=False,
 ):
     """
     From https://github.com/huggingface/diffusers/blob/main/scripts/convert_stable_diffusion_checkpoint_to_onnx.py
@@ -304,20 +381,45 @@ def onnx_export(
     output_path.parent.mkdir(parents=True, exist_ok=True)
     output_file = output_path.absolute().as_posix()
 
-    export(
-        model,
-        model_args,
-        f=output_file,
-        input_names=ordered_input_names,
-        output_names=output_names,
-        dynamic_axes=dynamic_axes,
-        do_constant_folding=True,
-        opset_version=opset,
-    )
+    if dynamo and has_dynamo_export:
+        # lower through TorchDynamo, which skips TorchScript tracing and writes
+        # external weights in a single file rather than one per tensor
+        export(
+            model,
+            model_args,
+            f=output_file,
+            input_names=ordered_input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            dynamo=True,
+            external_data=external_data,
+        )
+    else:
+        if dynamo:
+            logger.warning(
+                "dynamo export requires torch 2.6 or better and onnxscript, "
+                "using TorchScript"
+            )
 
-    op_block_list = None
+        # newer torch versions default to the dynamo exporter, so pin the
+        # TorchScript path explicitly when the parameter exists
+        extra_args = {"dynamo": False} if is_torch_2_6 else {}
+        export(
+            model,
+            model_args,
+            f=output_file,
+            input_names=ordered_input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            do_constant_folding=True,
+            opset_version=opset,
+            **extra_args,
+        )
+
+    op_block_list = list(FP16_BLOCKED_OPS)
     if v2:
-        op_block_list = ["Attention", "MultiHeadAttention"]
+        op_block_list.extend(["Attention", "MultiHeadAttention"])
 
     if half:
         logger.info("converting model to fp16 internally: %s", output_file)
@@ -337,3 +439,148 @@ def onnx_export(
             all_tensors_to_one_file=True,
             location=ONNX_WEIGHTS,
         )
+
+
+def onnx_optimize(
+    model_path: str,
+    model_type: str,
+    external_data: bool = False,
+):
+    """
+    Run the ORT transformer optimizer over an exported model, fusing attention and
+    normalization ops so sessions do not pay the fusion cost on every load. FP16
+    conversion already happens during export, so only the graph passes run here.
+    """
+    logger.info("optimizing %s graph: %s", model_type, model_path)
+    opt = optimize_model(
+        model_path,
+        model_type=model_type,
+        # auto-detect from the graph
+        num_heads=0,
+        hidden_size=0,
+        opt_level=1,
+        use_gpu=False,
+        only_onnxruntime=False,
+    )
+    save_model(
+        opt.model,
+        model_path,
+        save_as_external_data=external_data,
+        all_tensors_to_one_file=True,
+        location=ONNX_WEIGHTS,
+    )
+
+
+def free_training_memory(device: str) -> None:
+    """
+    Release the CUDA allocator arenas between submodel exports. Deleting the
+    submodel alone leaves the arenas mapped, which is enough to OOM the next
+    export on smaller cards.
+    """
+    gc.collect()
+
+    if torch.cuda.is_available() and device.startswith("cuda"):
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
+
+
+def hash_file(name: str) -> str:
+    sha = sha256()
+    with open(name, "rb") as f:
+        # stream in chunks, some of these files are very large
+        for chunk in iter(partial(f.read, 1024 * 1024), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def check_converted_model(conversion: ServerContext, dest: str) -> bool:
+    """
+    Whether the converted model at dest can be reused, based on its sidecar
+    metadata. A bare isfile check misses corrupt exports and opset or dtype
+    changes, so skip only when everything matches.
+    """
+    meta_file = f"{dest}.meta.json"
+    if not path.isfile(dest) or not path.isfile(meta_file):
+        return False
+
+    try:
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+    except Exception:
+        logger.debug("unable to load metadata for converted model: %s", dest)
+        return False
+
+    if (
+        meta.get("opset") != conversion.opset
+        or meta.get("half") != conversion.half
+        or meta.get("converter_version") != conversion.server_version
+    ):
+        logger.info("converted model is out of date, converting again: %s", dest)
+        return False
+
+    if meta.get("sha256") != hash_file(dest):
+        logger.warning(
+            "converted model does not match its hash, converting again: %s", dest
+        )
+        return False
+
+    return True
+
+
+def save_converted_model_meta(conversion: ServerContext, dest: str) -> None:
+    meta_file = f"{dest}.meta.json"
+    logger.debug("saving metadata for converted model: %s", meta_file)
+    with open(meta_file, "w") as f:
+        json.dump(
+            {
+                "converter_version": conversion.server_version,
+                "half": conversion.half,
+                "opset": conversion.opset,
+                "sha256": hash_file(dest),
+            },
+            f,
+        )
+
+
+class RandomCalibrationData(CalibrationDataReader):
+    """
+    Feed randomly generated inputs to the static quantizer's calibration pass.
+    Diffusion activations vary smoothly with the latents, so random samples in the
+    latent range produce usable activation ranges without a calibration dataset.
+    """
+
+    def __init__(self, make_inputs: Callable[[], Dict[str, Any]], rounds: int = 50):
+        self.make_inputs = make_inputs
+        self.rounds = rounds
+
+    def get_next(self):
+        if self.rounds <= 0:
+            return None
+
+        self.rounds -= 1
+        return self.make_inputs()
+
+
+def onnx_quantize(
+    model_path: str,
+    dest_path: str,
+    make_inputs: Callable[[], Dict[str, Any]],
+    rounds: int = 50,
+):
+    """
+    Run ORT static QDQ quantization over an exported model, writing the int8 variant
+    alongside the original so load_pipeline can select between them.
+    """
+    logger.info("quantizing model to int8: %s -> %s", model_path, dest_path)
+    quantize_static(
+        model_path,
+        dest_path,
+        RandomCalibrationData(make_inputs, rounds=rounds),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        weight_type=QuantType.QInt8,
+        activation_type=QuantType.QUInt8,
+        extra_options={"ActivationSymmetric": False},
+    )
@@ -1,11 +1,17 @@
+from hashlib import blake2b
+from json import dumps
 from logging import getLogger
-from os import path
+from os import listdir, makedirs, path, utime
+from shutil import rmtree
 from typing import Any, List, Optional, Tuple
 
-from onnx import load_model
+import numpy as np
+from diffusers.pipelines.onnx_utils import ORT_TO_NP_TYPE
+from onnx import load_model, save_model
+from onnx.external_data_helper import load_external_data_for_model
 from transformers import CLIPTokenizer
 
-from ..constants import ONNX_MODEL
+from ..constants import ONNX_MODEL, ONNX_MODEL_INT8, ONNX_WEIGHTS
 from ..convert.diffusion.lora import blend_loras, buffer_external_data_tensors
 from ..convert.diffusion.textual_inversion import blend_textual_inversions
 from ..diffusers.pipelines.upscale import OnnxStableDiffusionUpscalePipeline
@@ -73,6 +79,10 @@ pipeline_schedulers = {
     "unipc-multi": UniPCMultistepScheduler,
 }
 
+# reverse maps for get_scheduler_name, which runs on every request
+scheduler_names = {v: k for k, v in pipeline_schedulers.items()}
+scheduler_names.update({v.__name__: k for k, v in pipeline_schedulers.items()})
+
 
 def get_available_pipelines() -> List[str]:
     return list(available_pipelines.keys())
@@ -83,11 +93,44 @@ def get_pipeline_schedulers() -> List[str]:
 
 
 def get_scheduler_name(scheduler: Any) -> Optional[str]:
-    for k, v in pipeline_schedulers.items():
-        if scheduler == v or scheduler == v.__name__:
-            return k
+    return scheduler_names.get(scheduler, None)
+
+
+def prune_blend_cache(server: ServerContext) -> None:
+    """
+    Evict the oldest entries from the blended model disk cache, keeping the same
+    number of entries as the in-memory model cache.
+    """
+    blend_root = path.join(server.cache_path, "blend")
+    entries = sorted(
+        (path.join(blend_root, name) for name in listdir(blend_root)),
+        key=path.getmtime,
+    )
+
+    overage = len(entries) - server.cache_limit
+    if overage > 0:
+        for entry in entries[:overage]:
+            logger.info("pruning blended model cache entry: %s", entry)
+            rmtree(entry, ignore_errors=True)
+
+
+def select_model_file(
+    server: ServerContext, device: DeviceParams, model_dir: str
+) -> str:
+    """
+    Select the int8 quantized variant of a converted model when one exists and the
+    active provider has int8 kernels.
+    """
+    if "onnx-int8" in server.optimizations and device.provider in (
+        "CPUExecutionProvider",
+        "TensorrtExecutionProvider",
+    ):
+        int8_model = path.join(model_dir, ONNX_MODEL_INT8)
+        if path.exists(int8_model):
+            logger.debug("using int8 quantized model: %s", int8_model)
+            return int8_model
 
-    return None
+    return path.join(model_dir, ONNX_MODEL)
 
 
 def load_pipeline(
@@ -150,11 +193,16 @@ def load_pipeline(
             run_gc([device])
 
         logger.debug("loading new diffusion pipeline from %s", model)
+
+        # one set of session options is shared by every component that does not
+        # bind external initializers; those get a private copy via cache=False,
+        # since add_external_initializers mutates the options
+        base_opts = device.sess_options()
         components = {
             "scheduler": scheduler_type.from_pretrained(
                 model,
                 provider=device.ort_provider(),
-                sess_options=device.sess_options(),
+                sess_options=base_opts,
                 subfolder="scheduler",
                 torch_dtype=torch_dtype,
             )
@@ -174,7 +222,7 @@ def load_pipeline(
                 OnnxRuntimeModel.load_model(
                     cnet_path,
                     provider=device.ort_provider(),
-                    sess_options=device.sess_options(),
+                    sess_options=base_opts,
                 )
             )
 
@@ -217,7 +265,7 @@ def load_pipeline(
                     OnnxRuntimeModel.load_model(
                         text_encoder.SerializeToString(),
                         provider=device.ort_provider("text-encoder"),
-                        sess_options=device.sess_options(),
+                        sess_options=base_opts,
                     )
                 )
 
@@ -231,17 +279,106 @@ def load_pipeline(
                 "blending base model %s with LoRA models: %s", model, lora_models
             )
 
-            # blend and load text encoder
-            text_encoder = text_encoder or path.join(model, "text_encoder", ONNX_MODEL)
-            text_encoder = blend_loras(
-                server,
-                text_encoder,
-                list(zip(lora_models, lora_weights)),
-                "text_encoder",
-            )
-            (text_encoder, text_encoder_data) = buffer_external_data_tensors(
-                text_encoder
-            )
+            # blending and serializing the protos can take several seconds for a large
+            # UNet, so the resulting bytes are cached keyed on the full blend recipe
+            blend_key = (model, unet_type, tuple(inversions), tuple(loras))
+            blended = server.cache.get(ModelTypes.blended, blend_key)
+            if blended is not None:
+                logger.debug("reusing blended and serialized models")
+                (
+                    text_encoder_bytes,
+                    text_encoder_data,
+                    unet_bytes,
+                    unet_data,
+                ) = blended
+            else:
+                # the blended models also go into a bounded disk cache keyed on the
+                # blend recipe, so restarts and evicted swaps skip the blend
+                blend_digest = blake2b(
+                    dumps([model, unet_type, inversions, loras]).encode("utf-8"),
+                    digest_size=16,
+                ).hexdigest()
+                blend_path = path.join(server.cache_path, "blend", blend_digest)
+                text_encoder_file = path.join(blend_path, "text_encoder", ONNX_MODEL)
+                unet_file = path.join(blend_path, unet_type, ONNX_MODEL)
+
+                if path.exists(text_encoder_file) and path.exists(unet_file):
+                    logger.debug("reusing blended models from %s", blend_path)
+                    utime(blend_path)
+                    text_encoder = load_model(
+                        text_encoder_file, load_external_data=False
+                    )
+                    blended_unet = load_model(unet_file, load_external_data=False)
+                else:
+                    # blend text encoder
+                    text_encoder = text_encoder or path.join(
+                        model, "text_encoder", ONNX_MODEL
+                    )
+                    text_encoder = blend_loras(
+                        server,
+                        text_encoder,
+                        list(zip(lora_models, lora_weights)),
+                        "text_encoder",
+                    )
+
+                    # blend unet
+                    unet = path.join(model, unet_type, ONNX_MODEL)
+                    blended_unet = blend_loras(
+                        server,
+                        unet,
+                        list(zip(lora_models, lora_weights)),
+                        "unet",
+                    )
+
+                    # save both to the disk cache, which also converts their tensors
+                    # to external references into the cached weights
+                    logger.debug("saving blended models to %s", blend_path)
+                    load_external_data_for_model(
+                        text_encoder, path.join(model, "text_encoder")
+                    )
+                    makedirs(path.dirname(text_encoder_file), exist_ok=True)
+                    save_model(
+                        text_encoder,
+                        text_encoder_file,
+                        save_as_external_data=True,
+                        all_tensors_to_one_file=True,
+                        location=ONNX_WEIGHTS,
+                    )
+
+                    load_external_data_for_model(
+                        blended_unet, path.join(model, unet_type)
+                    )
+                    makedirs(path.dirname(unet_file), exist_ok=True)
+                    save_model(
+                        blended_unet,
+                        unet_file,
+                        save_as_external_data=True,
+                        all_tensors_to_one_file=True,
+                        location=ONNX_WEIGHTS,
+                    )
+
+                    prune_blend_cache(server)
+
+                # serialize both, with the weights coming back as memory-mapped views
+                # of the cached weights.pb so the serialized bytes stay small and warm
+                # pages are served from the OS page cache
+                text_encoder, text_encoder_data = buffer_external_data_tensors(
+                    text_encoder, path.join(blend_path, "text_encoder")
+                )
+                text_encoder_bytes = text_encoder.SerializeToString()
+
+                unet_model, unet_data = buffer_external_data_tensors(
+                    blended_unet, path.join(blend_path, unet_type)
+                )
+                unet_bytes = unet_model.SerializeToString()
+
+                server.cache.set(
+                    ModelTypes.blended,
+                    blend_key,
+                    (text_encoder_bytes, text_encoder_data, unet_bytes, unet_data),
+                )
+
+            # load text encoder
             text_encoder_names, text_encoder_values = zip(*text_encoder_data)
             text_encoder_opts = device.sess_options(cache=False)
             text_encoder_opts.add_external_initializers(
@@ -249,27 +386,19 @@ def load_pipeline(
             )
             components["text_encoder"] = OnnxRuntimeModel(
                 OnnxRuntimeModel.load_model(
-                    text_encoder.SerializeToString(),
+                    text_encoder_bytes,
                     provider=device.ort_provider("text-encoder"),
                     sess_options=text_encoder_opts,
                 )
             )
 
-            # blend and load unet
-            unet = path.join(model, unet_type, ONNX_MODEL)
-            blended_unet = blend_loras(
-                server,
-                unet,
-                list(zip(lora_models, lora_weights)),
-                "unet",
-            )
-            (unet_model, unet_data) = buffer_external_data_tensors(blended_unet)
+            # load unet
             unet_names, unet_values = zip(*unet_data)
             unet_opts = device.sess_options(cache=False)
             unet_opts.add_external_initializers(list(unet_names), list(unet_values))
             components["unet"] = OnnxRuntimeModel(
                 OnnxRuntimeModel.load_model(
-                    unet_model.SerializeToString(),
+                    unet_bytes,
                     provider=device.ort_provider("unet"),
                     sess_options=unet_opts,
                 )
@@ -277,20 +406,20 @@ def load_pipeline(
 
         # make sure a UNet has been loaded
         if "unet" not in components:
-            unet = path.join(model, unet_type, ONNX_MODEL)
+            unet = select_model_file(server, device, path.join(model, unet_type))
             logger.debug("loading UNet (%s) from %s", unet_type, unet)
             components["unet"] = OnnxRuntimeModel(
                 OnnxRuntimeModel.load_model(
                     unet,
                     provider=device.ort_provider("unet"),
-                    sess_options=device.sess_options(),
+                    sess_options=base_opts,
                 )
             )
 
         # one or more VAE models need to be loaded
-        vae = path.join(model, "vae", ONNX_MODEL)
-        vae_decoder = path.join(model, "vae_decoder", ONNX_MODEL)
-        vae_encoder = path.join(model, "vae_encoder", ONNX_MODEL)
+        vae = select_model_file(server, device, path.join(model, "vae"))
+        vae_decoder = select_model_file(server, device, path.join(model, "vae_decoder"))
+        vae_encoder = select_model_file(server, device, path.join(model, "vae_encoder"))
 
         if path.exists(vae):
             logger.debug("loading VAE from %s", vae)
@@ -298,7 +427,7 @@ def load_pipeline(
                 OnnxRuntimeModel.load_model(
                     vae,
                     provider=device.ort_provider("vae"),
-                    sess_options=device.sess_options(),
+                    sess_options=base_opts,
                 )
             )
         elif path.exists(vae_decoder) and path.exists(vae_encoder):
@@ -307,7 +436,7 @@ def load_pipeline(
                 OnnxRuntimeModel.load_model(
                     vae_decoder,
                     provider=device.ort_provider("vae"),
-                    sess_options=device.sess_options(),
+                    sess_options=base_opts,
                 )
             )
 
@@ -316,7 +445,7 @@ def load_pipeline(
                 OnnxRuntimeModel.load_model(
                     vae_encoder,
                     provider=device.ort_provider("vae"),
-                    sess_options=device.sess_options(),
+                    sess_options=base_opts,
                 )
             )
 
@@ -330,7 +459,7 @@ def load_pipeline(
         pipe = pipeline_class.from_pretrained(
             model,
             provider=device.ort_provider(),
-            sess_options=device.sess_options(),
+            sess_options=base_opts,
             safety_checker=None,
             torch_dtype=torch_dtype,
             **components,
@@ -340,7 +469,10 @@ def load_pipeline(
             pipe.set_progress_bar_config(disable=True)
 
         optimize_pipeline(server, pipe)
-        patch_pipeline(server, pipe, pipeline, pipeline_class, params)
+        patch_pipeline(server, pipe, pipeline, pipeline_class, params, device)
+
+        if "onnx-session-warmup" in server.optimizations:
+            warmup_pipeline(pipe)
 
         server.cache.set(ModelTypes.diffusion, pipe_key, pipe)
         server.cache.set(ModelTypes.scheduler, scheduler_key, components["scheduler"])
@@ -364,6 +496,49 @@ def load_pipeline(
     return pipe
 
 
+def warmup_session(wrapped, **inputs) -> Optional[Any]:
+    try:
+        return wrapped(**inputs)
+    except Exception:
+        logger.debug("session warmup failed", exc_info=True)
+        return None
+
+
+def warmup_pipeline(pipe) -> None:
+    """
+    Run each session once with small synthetic inputs, so the first real request
+    does not pay for ORT's lazy kernel selection and allocator growth.
+    """
+    logger.debug("warming up pipeline sessions")
+
+    hidden_states = None
+    if hasattr(pipe, "text_encoder"):
+        hidden_states = warmup_session(
+            pipe.text_encoder, input_ids=np.zeros((1, 77), dtype=np.int32)
+        )
+
+    if hidden_states is not None and hasattr(pipe, "unet"):
+        sample_dtype = next(
+            (
+                ORT_TO_NP_TYPE[input.type]
+                for input in pipe.unet.model.get_inputs()
+                if input.name == "sample"
+            ),
+            np.float32,
+        )
+        warmup_session(
+            pipe.unet,
+            sample=np.zeros((1, 4, 64, 64), dtype=sample_dtype),
+            timestep=np.zeros((1,), dtype=sample_dtype),
+            encoder_hidden_states=hidden_states[0].astype(sample_dtype),
+        )
+
+    if hasattr(pipe, "vae_decoder"):
+        warmup_session(
+            pipe.vae_decoder, latent_sample=np.zeros((1, 4, 8, 8), dtype=np.float32)
+        )
+
+
 def optimize_pipeline(
     server: ServerContext,
     pipe: StableDiffusionPipeline,
@@ -400,20 +575,24 @@ def optimize_pipeline(
             logger.warning("error while enabling sequential CPU offload: %s", e)
 
     elif "diffusers-cpu-offload-model" in server.optimizations:
-        # TODO: check for accelerate
-        logger.debug("enabling model CPU offload on SD pipeline")
-        try:
-            pipe.enable_model_cpu_offload()
-        except Exception as e:
-            logger.warning("error while enabling model CPU offload: %s", e)
+        if server.has_accelerate:
+            logger.debug("enabling model CPU offload on SD pipeline")
+            try:
+                pipe.enable_model_cpu_offload()
+            except Exception as e:
+                logger.warning("error while enabling model CPU offload: %s", e)
+        else:
+            logger.warning("model CPU offload requires accelerate")
 
     if "diffusers-memory-efficient-attention" in server.optimizations:
-        # TODO: check for xformers
-        logger.debug("enabling memory efficient attention for SD pipeline")
-        try:
-            pipe.enable_xformers_memory_efficient_attention()
-        except Exception as e:
-            logger.warning("error while enabling memory efficient attention: %s", e)
+        if server.has_xformers:
+            logger.debug("enabling memory efficient attention for SD pipeline")
+            try:
+                pipe.enable_xformers_memory_efficient_attention()
+            except Exception as e:
+                logger.warning("error while enabling memory efficient attention: %s", e)
+        else:
+            logger.warning("memory efficient attention requires xformers")
 
 
 def patch_pipeline(
@@ -422,6 +601,7 @@ def patch_pipeline(
     pipe_type: str,
     pipeline: Any,
     params: ImageParams,
+    device: Optional[DeviceParams] = None,
 ) -> None:
     logger.debug("patching SD pipeline")
 
@@ -429,7 +609,7 @@ def patch_pipeline(
         pipe._encode_prompt = expand_prompt.__get__(pipe, pipeline)
 
     original_unet = pipe.unet
-    pipe.unet = UNetWrapper(server, original_unet)
+    pipe.unet = UNetWrapper(server, original_unet, device=device)
 
     if hasattr(pipe, "vae_decoder"):
         original_decoder = pipe.vae_decoder
@@ -439,6 +619,7 @@ def patch_pipeline(
             decoder=True,
             window=params.tiles,
             overlap=params.overlap,
+            device=device,
         )
         original_encoder = pipe.vae_encoder
         pipe.vae_encoder = VAEWrapper(
@@ -447,6 +628,7 @@ def patch_pipeline(
             decoder=False,
             window=params.tiles,
             overlap=params.overlap,
+            device=device,
         )
     elif hasattr(pipe, "vae"):
         pass  # TODO: current wrapper does not work with upscaling VAE
@@ -4,10 +4,49 @@ from typing import List, Optional
 import numpy as np
 from diffusers import OnnxRuntimeModel
 
+from ...params import DeviceParams
 from ...server import ServerContext
 
 logger = getLogger(__name__)
 
+# providers where binding the session inputs and outputs to the device avoids a
+# host copy on every step
+IO_BINDING_DEVICES = {
+    "CUDAExecutionProvider": "cuda",
+    "DmlExecutionProvider": "dml",
+    "ROCMExecutionProvider": "cuda",
+}
+
+
+def run_io_binding(wrapped: OnnxRuntimeModel, device: DeviceParams, **kwargs):
+    """
+    Run the wrapped session with inputs and outputs bound to the device, rather
+    than copying numpy arrays through host memory on every call.
+    """
+    from onnxruntime import OrtValue
+
+    session = wrapped.model
+    device_type = IO_BINDING_DEVICES[device.provider]
+    device_id = (device.options or {}).get("device_id", 0)
+
+    binding = session.io_binding()
+    for name, value in kwargs.items():
+        if value is None:
+            continue
+
+        binding.bind_ortvalue_input(
+            name, OrtValue.ortvalue_from_numpy(value, device_type, device_id)
+        )
+
+    for output in session.get_outputs():
+        binding.bind_output(output.name, device_type, device_id)
+
+    binding.synchronize_inputs()
+    session.run_with_iobinding(binding)
+    binding.synchronize_outputs()
+
+    return [output.numpy() for output in binding.get_outputs()]
+
 
 class UNetWrapper(object):
     prompt_embeds: Optional[List[np.ndarray]] = None
@@ -19,9 +58,12 @@ class UNetWrapper(object):
         self,
         server: ServerContext,
         wrapped: OnnxRuntimeModel,
+        device: Optional[DeviceParams] = None,
     ):
         self.server = server
         self.wrapped = wrapped
+        self.device = device
+        self.io_binding = device is not None and device.provider in IO_BINDING_DEVICES
 
     def __call__(
         self,
@@ -51,6 +93,16 @@ class UNetWrapper(object):
             logger.trace("converting UNet hidden states to timestep dtype")
             encoder_hidden_states = encoder_hidden_states.astype(timestep.dtype)
 
+        if self.io_binding:
+            return run_io_binding(
+                self.wrapped,
+                self.device,
+                sample=sample,
+                timestep=timestep,
+                encoder_hidden_states=encoder_hidden_states,
+                **kwargs,
+            )
+
         return self.wrapped(
             sample=sample,
             timestep=timestep,
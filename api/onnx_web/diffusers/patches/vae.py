@@ -1,5 +1,5 @@
 from logging import getLogger
-from typing import Union
+from typing import Optional, Union
 
 import numpy as np
 import torch
@@ -8,7 +8,9 @@ from diffusers.models.autoencoder_kl import AutoencoderKLOutput
 from diffusers.models.vae import DecoderOutput
 from diffusers.pipelines.onnx_utils import ORT_TO_NP_TYPE
 
+from ...params import DeviceParams
 from ...server import ServerContext
+from .unet import IO_BINDING_DEVICES, run_io_binding
 
 logger = getLogger(__name__)
 
@@ -23,11 +25,14 @@ class VAEWrapper(object):
         decoder: bool,
         window: int,
         overlap: float,
+        device: Optional[DeviceParams] = None,
     ):
         self.server = server
         self.wrapped = wrapped
         self.decoder = decoder
         self.tiled = False
+        self.device = device
+        self.io_binding = device is not None and device.provider in IO_BINDING_DEVICES
         self.set_window_size(window, overlap)
 
     def set_tiled(self, tiled: bool = True):
@@ -70,6 +75,13 @@ class VAEWrapper(object):
                 return self.tiled_decode(latent_sample, **kwargs)
             else:
                 return self.tiled_encode(sample, **kwargs)
+        elif self.io_binding:
+            if self.decoder:
+                return run_io_binding(
+                    self.wrapped, self.device, latent_sample=latent_sample
+                )
+            else:
+                return run_io_binding(self.wrapped, self.device, sample=sample)
         else:
             if self.decoder:
                 return self.wrapped(latent_sample=latent_sample)
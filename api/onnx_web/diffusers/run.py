@@ -228,13 +228,14 @@ def run_inpaint_pipeline(
     tile_size = params.tiles
 
     if mask is None:
-        # if no mask was provided, keep the full source image
-        mask = Image.new("L", source.size, 0)
-
-    # masks start as 512x512, resize to cover the source, then trim the extra
-    mask_max = max(source.width, source.height)
-    mask = ImageOps.contain(mask, (mask_max, mask_max))
-    mask = mask.crop((0, 0, source.width, source.height))
+        # if no mask was provided, keep the full source image; expand_image will build
+        # a border-only mask without allocating a full black canvas
+        logger.debug("no mask provided, only painting the expanded border")
+    else:
+        # masks start as 512x512, resize to cover the source, then trim the extra
+        mask_max = max(source.width, source.height)
+        mask = ImageOps.contain(mask, (mask_max, mask_max))
+        mask = mask.crop((0, 0, source.width, source.height))
 
     source, mask, noise, full_size = expand_image(
         source,
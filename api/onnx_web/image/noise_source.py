@@ -1,12 +1,71 @@
+from collections import OrderedDict
+from hashlib import blake2b
+
 import numpy as np
 from numpy import random
 from PIL import Image, ImageFilter
 
 from ..params import Point
 
+try:
+    from numba import njit, prange
+
+    @njit(parallel=True, fastmath=True)
+    def sample_histogram_channels(
+        cdfs: np.ndarray, samples: np.ndarray, out: np.ndarray
+    ) -> None:
+        """
+        Inverse-CDF sampling over the channel histograms, one uniform sample per pixel
+        per channel. The binary search runs in parallel over the pixels.
+        """
+        for i in prange(samples.shape[0]):
+            for c in range(3):
+                value = samples[i, c]
+                low = 0
+                high = 255
+                while low < high:
+                    mid = (low + high) // 2
+                    if cdfs[c, mid] < value:
+                        low = mid + 1
+                    else:
+                        high = mid
+
+                out[i, c] = low
+
+except ImportError:
+    sample_histogram_channels = None
+
+
+CDF_CACHE_LIMIT = 32
+
+channel_cdf_cache = OrderedDict()
+
 
-def get_pixel_index(x: int, y: int, width: int) -> int:
-    return (y * width) + x
+def channel_cdfs(source: Image.Image) -> np.ndarray:
+    """
+    Compute the normalized per-channel CDFs for a source image, cached on the
+    image content. The histogram is deterministic for a given image, so
+    repeated outpaints of the same source skip the histogram and cumsum.
+    """
+    key = blake2b(source.tobytes(), digest_size=16).digest()
+    cdfs = channel_cdf_cache.get(key)
+    if cdfs is not None:
+        channel_cdf_cache.move_to_end(key)
+        return cdfs
+
+    r, g, b = source.split()
+    cdfs = np.cumsum(
+        np.stack([r.histogram(), g.histogram(), b.histogram()]),
+        axis=1,
+        dtype=np.float64,
+    )
+    cdfs /= cdfs[:, -1:]
+
+    channel_cdf_cache[key] = cdfs
+    while len(channel_cdf_cache) > CDF_CACHE_LIMIT:
+        channel_cdf_cache.popitem(last=False)
+
+    return cdfs
 
 
 def noise_source_fill_edge(
@@ -55,68 +114,46 @@ def noise_source_uniform(
     _source: Image.Image, dims: Point, _origin: Point, **kw
 ) -> Image.Image:
     width, height = dims
-    size = width * height
 
-    noise_r = random.uniform(0, 256, size=size)
-    noise_g = random.uniform(0, 256, size=size)
-    noise_b = random.uniform(0, 256, size=size)
+    noise = random.uniform(0, 256, size=(height, width, 3))
 
-    noise = Image.new("RGB", (width, height))
-
-    for x in range(width):
-        for y in range(height):
-            i = get_pixel_index(x, y, width)
-            noise.putpixel((x, y), (int(noise_r[i]), int(noise_g[i]), int(noise_b[i])))
-
-    return noise
+    return Image.fromarray(noise.astype(np.uint8), "RGB")
 
 
 def noise_source_normal(
     _source: Image.Image, dims: Point, _origin: Point, **kw
 ) -> Image.Image:
     width, height = dims
-    size = width * height
 
-    noise_r = random.normal(128, 32, size=size)
-    noise_g = random.normal(128, 32, size=size)
-    noise_b = random.normal(128, 32, size=size)
+    noise = np.clip(random.normal(128, 32, size=(height, width, 3)), 0, 255)
 
-    noise = Image.new("RGB", (width, height))
-
-    for x in range(width):
-        for y in range(height):
-            i = get_pixel_index(x, y, width)
-            noise.putpixel((x, y), (int(noise_r[i]), int(noise_g[i]), int(noise_b[i])))
-
-    return noise
+    return Image.fromarray(noise.astype(np.uint8), "RGB")
 
 
 def noise_source_histogram(
     source: Image.Image, dims: Point, _origin: Point, **kw
 ) -> Image.Image:
-    r, g, b = source.split()
+    """
+    Draw noise matching the source's channel histograms via inverse-CDF
+    sampling, one cumsum per channel rather than rebuilding the distribution
+    for every draw.
+    """
     width, height = dims
     size = width * height
 
-    hist_r = r.histogram()
-    hist_g = g.histogram()
-    hist_b = b.histogram()
+    cdfs = channel_cdfs(source)
 
-    noise_r = random.choice(
-        256, p=np.divide(np.copy(hist_r), np.sum(hist_r)), size=size
-    )
-    noise_g = random.choice(
-        256, p=np.divide(np.copy(hist_g), np.sum(hist_g)), size=size
-    )
-    noise_b = random.choice(
-        256, p=np.divide(np.copy(hist_b), np.sum(hist_b)), size=size
-    )
-
-    noise = Image.new("RGB", (width, height))
+    # float32 uniforms are plenty for 256 bins and halve the sample buffer
+    samples = random.random_sample((size, 3)).astype(np.float32)
 
-    for x in range(width):
-        for y in range(height):
-            i = get_pixel_index(x, y, width)
-            noise.putpixel((x, y), (noise_r[i], noise_g[i], noise_b[i]))
+    # fill one contiguous uint8 buffer per channel rather than stacking
+    # three intermediate arrays, so the blend that follows stays memory-bound
+    # on a single allocation
+    out = np.empty((size, 3), dtype=np.uint8)
+    if sample_histogram_channels is not None:
+        sample_histogram_channels(cdfs, samples, out)
+    else:
+        for c in range(3):
+            out[:, c] = np.searchsorted(cdfs[c], samples[:, c])
 
-    return noise
+    return Image.fromarray(out.reshape((height, width, 3)), "RGB")
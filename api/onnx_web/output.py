@@ -1,4 +1,6 @@
-from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from hashlib import blake2b, sha256
 from json import dumps
 from logging import getLogger
 from os import path
@@ -15,12 +17,22 @@ from onnx_web.server.load import get_extra_hashes
 
 from .params import Border, HighresParams, ImageParams, Param, Size, UpscaleParams
 from .server import ServerContext
-from .utils import base_join
+from .utils import base_join, is_debug
 
 logger = getLogger(__name__)
 
 HASH_BUFFER_SIZE = 2**22  # 4MB
 
+# debug images are written from a single background thread, keeping the PNG encode
+# and disk flush off the critical path of the stage that produced them
+debug_io_pool = ThreadPoolExecutor(max_workers=1) if is_debug() else None
+
+
+def save_debug_image(server: ServerContext, output: str, image: Image.Image) -> None:
+    if debug_io_pool is not None:
+        # copy the image so later in-place edits do not race the background writer
+        debug_io_pool.submit(save_image, server, output, image.copy())
+
 
 def hash_file(name: str):
     sha = sha256()
@@ -35,19 +47,25 @@ def hash_file(name: str):
     return sha.hexdigest()
 
 
-def hash_value(sha, param: Optional[Param]):
+def pack_value(param: Optional[Param]) -> bytes:
     if param is None:
-        return
+        return b""
     elif isinstance(param, bool):
-        sha.update(bytearray(pack("!B", param)))
+        return pack("!B", param)
     elif isinstance(param, float):
-        sha.update(bytearray(pack("!f", param)))
+        return pack("!f", param)
     elif isinstance(param, int):
-        sha.update(bytearray(pack("!I", param)))
+        return pack("!I", param)
     elif isinstance(param, str):
-        sha.update(param.encode("utf-8"))
+        return param.encode("utf-8")
     else:
         logger.warn("cannot hash param: %s, %s", param, type(param))
+        return b""
+
+
+def hash_value(sha, param: Optional[Param]):
+    if param is not None:
+        sha.update(pack_value(param))
 
 
 def json_params(
@@ -149,6 +167,24 @@ def str_params(
     )
 
 
+@lru_cache(maxsize=128)
+def hash_prefix(*values: Optional[Param]):
+    """
+    Hash the shared prefix of an output name once and memoize the digest
+    state, so variants of the same request only hash their differences.
+    Callers must copy the state before updating it.
+
+    Output names only need to be unique, not tamper-proof, so this uses
+    BLAKE2b, which is faster than SHA256 without hardware support.
+    """
+    sha = blake2b(digest_size=16)
+
+    # one update over NUL-separated fields rather than ~10 short ones
+    sha.update(b"\0".join([pack_value(value) for value in values]))
+
+    return sha
+
+
 def make_output_name(
     server: ServerContext,
     mode: str,
@@ -159,19 +195,20 @@ def make_output_name(
 ) -> List[str]:
     count = count or params.batch
     now = int(time())
-    sha = sha256()
 
-    hash_value(sha, mode)
-    hash_value(sha, params.model)
-    hash_value(sha, params.pipeline)
-    hash_value(sha, params.scheduler)
-    hash_value(sha, params.prompt)
-    hash_value(sha, params.negative_prompt)
-    hash_value(sha, params.cfg)
-    hash_value(sha, params.seed)
-    hash_value(sha, params.steps)
-    hash_value(sha, params.eta)
-    hash_value(sha, params.batch)
+    sha = hash_prefix(
+        mode,
+        params.model,
+        params.pipeline,
+        params.scheduler,
+        params.prompt,
+        params.negative_prompt,
+        params.cfg,
+        params.seed,
+        params.steps,
+        params.eta,
+        params.batch,
+    ).copy()
     hash_value(sha, size.width)
     hash_value(sha, size.height)
 
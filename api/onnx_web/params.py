@@ -1,10 +1,11 @@
 from enum import IntEnum
 from logging import getLogger
 from math import ceil
+from os import cpu_count
 from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 
 from .models.meta import NetworkModel
-from .torch_before_ort import GraphOptimizationLevel, SessionOptions
+from .torch_before_ort import ExecutionMode, GraphOptimizationLevel, SessionOptions
 
 logger = getLogger(__name__)
 
@@ -34,6 +35,9 @@ class TileOrder:
 
 
 class Border:
+    # these are allocated per tile, so skip the per-instance dict
+    __slots__ = ("left", "right", "top", "bottom")
+
     def __init__(self, left: int, right: int, top: int, bottom: int) -> None:
         self.left = left
         self.right = right
@@ -70,6 +74,8 @@ class Border:
 
 
 class Size:
+    __slots__ = ("width", "height")
+
     def __init__(self, width: int, height: int) -> None:
         self.width = width
         self.height = height
@@ -109,6 +115,15 @@ class Size:
 
 
 class DeviceParams:
+    __slots__ = (
+        "device",
+        "provider",
+        "options",
+        "optimizations",
+        "sess_options_cache",
+        "torch_device",
+    )
+
     def __init__(
         self,
         device: str,
@@ -122,6 +137,16 @@ class DeviceParams:
         self.optimizations = optimizations or []
         self.sess_options_cache = None
 
+        # resolved once here, torch_str is called per stage and tile
+        if device.startswith("cuda") or device.startswith("rocm"):
+            torch_device = "cuda" if device.startswith("rocm") else device
+            if options is not None and "device_id" in options:
+                torch_device = f"{torch_device}:{options['device_id']}"
+
+            self.torch_device = torch_device
+        else:
+            self.torch_device = "cpu"
+
     def __str__(self) -> str:
         return "%s - %s (%s)" % (self.device, self.provider, self.options)
 
@@ -145,11 +170,27 @@ class DeviceParams:
 
         sess = SessionOptions()
 
+        if self.provider == "CPUExecutionProvider":
+            # cap the compute threads so sessions do not oversubscribe the cores
+            # shared with the worker pool
+            sess.intra_op_num_threads = min(cpu_count() or 1, 8)
+
+        if "onnx-parallel-execution" in self.optimizations:
+            logger.debug("enabling parallel ONNX graph execution")
+            sess.execution_mode = ExecutionMode.ORT_PARALLEL
+
+        if self.provider in ("CUDAExecutionProvider", "ROCMExecutionProvider"):
+            # use the serialized model bytes directly, skipping an internal copy
+            sess.add_session_config_entry("session.use_ort_model_bytes_directly", "1")
+
         if "onnx-low-memory" in self.optimizations:
             logger.debug("enabling ONNX low-memory optimizations")
             sess.enable_cpu_mem_arena = False
             sess.enable_mem_pattern = False
             sess.enable_mem_reuse = False
+        else:
+            sess.enable_cpu_mem_arena = True
+            sess.enable_mem_pattern = True
 
         if "onnx-graph-disable" in self.optimizations:
             logger.debug("disabling all ONNX graph optimizations")
@@ -171,21 +212,31 @@ class DeviceParams:
         return sess
 
     def torch_str(self) -> str:
-        if self.device.startswith("cuda"):
-            if self.options is not None and "device_id" in self.options:
-                return f"{self.device}:{self.options['device_id']}"
-
-            return self.device
-        elif self.device.startswith("rocm"):
-            if self.options is not None and "device_id" in self.options:
-                return f"cuda:{self.options['device_id']}"
-
-            return "cuda"
-        else:
-            return "cpu"
+        return self.torch_device
 
 
 class ImageParams:
+    __slots__ = (
+        "model",
+        "pipeline",
+        "scheduler",
+        "prompt",
+        "cfg",
+        "steps",
+        "seed",
+        "negative_prompt",
+        "eta",
+        "batch",
+        "control",
+        "input_prompt",
+        "input_negative_prompt",
+        "loopback",
+        "tiled_vae",
+        "tiles",
+        "overlap",
+        "stride",
+    )
+
     model: str
     pipeline: str
     scheduler: str
@@ -321,6 +372,8 @@ class StageParams:
     Parameters for a chained pipeline stage
     """
 
+    __slots__ = ("name", "outscale", "tile_order", "tile_size")
+
     def __init__(
         self,
         name: Optional[str] = None,
@@ -336,6 +389,21 @@ class StageParams:
 
 
 class UpscaleParams:
+    __slots__ = (
+        "upscale_model",
+        "correction_model",
+        "denoise",
+        "faces",
+        "face_outscale",
+        "face_strength",
+        "format",
+        "outscale",
+        "pre_pad",
+        "scale",
+        "tile_pad",
+        "upscale_order",
+    )
+
     def __init__(
         self,
         upscale_model: str,
@@ -426,6 +494,8 @@ class UpscaleParams:
 
 
 class HighresParams:
+    __slots__ = ("enabled", "scale", "steps", "strength", "method", "iterations")
+
     def __init__(
         self,
         enabled: bool,
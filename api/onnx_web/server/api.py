@@ -1,8 +1,12 @@
+from collections import OrderedDict
+from hashlib import sha256
 from io import BytesIO
 from logging import getLogger
 from os import path
+from time import sleep
+from typing import Optional
 
-from flask import Flask, jsonify, make_response, request, url_for
+from flask import Flask, Response, jsonify, make_response, request, url_for
 from jsonschema import validate
 from PIL import Image
 
@@ -58,23 +62,53 @@ from .utils import wrap_route
 
 logger = getLogger(__name__)
 
+UPLOAD_CACHE_LIMIT = 64
 
-def ready_reply(
+# uploads registered through the upload endpoint, so clients reusing the same
+# source across many jobs can send the bytes once and pass a handle after
+upload_cache = OrderedDict()
+
+
+def load_request_image(name: str) -> Optional[bytes]:
+    """
+    Read an image from the request, either a multipart file or a handle from
+    a previous upload.
+    """
+    handle = request.args.get(f"{name}Handle", None)
+    if handle is not None:
+        data = upload_cache.get(handle)
+        if data is not None:
+            upload_cache.move_to_end(handle)
+            return data
+
+        logger.warning("unknown upload handle: %s", handle)
+        return None
+
+    upload_file = request.files.get(name)
+    if upload_file is not None:
+        return upload_file.read()
+
+    return None
+
+
+def ready_json(
     ready: bool = False,
     cancelled: bool = False,
     failed: bool = False,
     pending: bool = False,
     progress: int = 0,
 ):
-    return jsonify(
-        {
-            "cancelled": cancelled,
-            "failed": failed,
-            "pending": pending,
-            "progress": progress,
-            "ready": ready,
-        }
-    )
+    return {
+        "cancelled": cancelled,
+        "failed": failed,
+        "pending": pending,
+        "progress": progress,
+        "ready": ready,
+    }
+
+
+def ready_reply(**kwargs):
+    return jsonify(ready_json(**kwargs))
 
 
 def error_reply(err: str):
@@ -158,12 +192,29 @@ def list_schedulers(server: ServerContext):
     return jsonify(get_pipeline_schedulers())
 
 
+def upload(server: ServerContext, pool: DevicePoolExecutor):
+    upload_file = request.files.get("file")
+    if upload_file is None:
+        return error_reply("file is required")
+
+    data = upload_file.read()
+    handle = sha256(data).hexdigest()[:16]
+
+    upload_cache[handle] = data
+    upload_cache.move_to_end(handle)
+    while len(upload_cache) > UPLOAD_CACHE_LIMIT:
+        upload_cache.popitem(last=False)
+
+    logger.debug("registered upload %s: %s bytes", handle, len(data))
+    return jsonify({"handle": handle})
+
+
 def img2img(server: ServerContext, pool: DevicePoolExecutor):
-    source_file = request.files.get("source")
-    if source_file is None:
+    source_data = load_request_image("source")
+    if source_data is None:
         return error_reply("source image is required")
 
-    source = Image.open(BytesIO(source_file.read())).convert("RGB")
+    source = Image.open(BytesIO(source_data)).convert("RGB")
     size = Size(source.width, source.height)
 
     device, params, _size = pipeline_from_request(server, "img2img")
@@ -242,18 +293,18 @@ def txt2img(server: ServerContext, pool: DevicePoolExecutor):
 
 
 def inpaint(server: ServerContext, pool: DevicePoolExecutor):
-    source_file = request.files.get("source")
-    if source_file is None:
+    source_data = load_request_image("source")
+    if source_data is None:
         return error_reply("source image is required")
 
-    mask_file = request.files.get("mask")
-    if mask_file is None:
+    mask_data = load_request_image("mask")
+    if mask_data is None:
         return error_reply("mask image is required")
 
-    source = Image.open(BytesIO(source_file.read())).convert("RGB")
+    source = Image.open(BytesIO(source_data)).convert("RGB")
     size = Size(source.width, source.height)
 
-    mask_top_layer = Image.open(BytesIO(mask_file.read())).convert("RGBA")
+    mask_top_layer = Image.open(BytesIO(mask_data)).convert("RGBA")
     mask = Image.new("RGBA", mask_top_layer.size, color=(0, 0, 0, 255))
     mask.alpha_composite(mask_top_layer)
     mask.convert(mode="L")
@@ -333,11 +384,11 @@ def inpaint(server: ServerContext, pool: DevicePoolExecutor):
 
 
 def upscale(server: ServerContext, pool: DevicePoolExecutor):
-    source_file = request.files.get("source")
-    if source_file is None:
+    source_data = load_request_image("source")
+    if source_data is None:
         return error_reply("source image is required")
 
-    source = Image.open(BytesIO(source_file.read())).convert("RGB")
+    source = Image.open(BytesIO(source_data)).convert("RGB")
 
     device, params, size = pipeline_from_request(server)
     upscale = upscale_from_request()
@@ -453,21 +504,21 @@ def chain(server: ServerContext, pool: DevicePoolExecutor):
 
 
 def blend(server: ServerContext, pool: DevicePoolExecutor):
-    mask_file = request.files.get("mask")
-    if mask_file is None:
+    mask_data = load_request_image("mask")
+    if mask_data is None:
         return error_reply("mask image is required")
 
-    mask = Image.open(BytesIO(mask_file.read())).convert("RGBA")
+    mask = Image.open(BytesIO(mask_data)).convert("RGBA")
 
     max_sources = 2
     sources = []
 
     for i in range(max_sources):
-        source_file = request.files.get("source:%s" % (i))
-        if source_file is None:
+        source_data = load_request_image("source:%s" % (i))
+        if source_data is None:
             logger.warning("missing source %s", i)
         else:
-            source = Image.open(BytesIO(source_file.read())).convert("RGBA")
+            source = Image.open(BytesIO(source_data)).convert("RGBA")
             sources.append(source)
 
     device, params, size = pipeline_from_request(server)
@@ -525,28 +576,23 @@ def cancel(server: ServerContext, pool: DevicePoolExecutor):
     return ready_reply(cancelled=cancelled)
 
 
-def ready(server: ServerContext, pool: DevicePoolExecutor):
-    output_file = request.args.get("output", None)
-    if output_file is None:
-        return error_reply("output name is required")
-
-    output_file = sanitize_name(output_file)
+def job_ready(server: ServerContext, pool: DevicePoolExecutor, output_file: str):
     pending, progress = pool.done(output_file)
 
     if pending:
-        return ready_reply(pending=True)
+        return ready_json(pending=True)
 
     if progress is None:
         output = base_join(server.output_path, output_file)
         if path.exists(output):
-            return ready_reply(ready=True)
+            return ready_json(ready=True)
         else:
-            return ready_reply(
+            return ready_json(
                 ready=True,
                 failed=True,
             )  # is a missing image really an error? yes will display the retry button
 
-    return ready_reply(
+    return ready_json(
         ready=progress.finished,
         progress=progress.progress,
         failed=progress.failed,
@@ -554,6 +600,44 @@ def ready(server: ServerContext, pool: DevicePoolExecutor):
     )
 
 
+def ready(server: ServerContext, pool: DevicePoolExecutor):
+    # batch form: check any number of in-flight jobs in one round-trip
+    outputs = request.args.get("outputs", None)
+    if outputs is not None:
+        keys = [sanitize_name(key) for key in outputs.split(",") if key]
+        return jsonify({key: job_ready(server, pool, key) for key in keys})
+
+    output_file = request.args.get("output", None)
+    if output_file is None:
+        return error_reply("output name is required")
+
+    output_file = sanitize_name(output_file)
+    return jsonify(job_ready(server, pool, output_file))
+
+
+def ready_stream(server: ServerContext, pool: DevicePoolExecutor):
+    output_file = request.args.get("output", None)
+    if output_file is None:
+        return error_reply("output name is required")
+
+    output_file = sanitize_name(output_file)
+
+    def job_events():
+        # push a ready event as soon as the job is done, so clients can block
+        # on one request instead of polling; pending events double as
+        # heartbeats and surface client disconnects
+        while True:
+            pending, progress = pool.done(output_file)
+            if not pending and (progress is None or progress.finished):
+                yield "data: ready\n\n"
+                return
+
+            yield "data: pending\n\n"
+            sleep(1)
+
+    return Response(job_events(), mimetype="text/event-stream")
+
+
 def register_api_routes(app: Flask, server: ServerContext, pool: DevicePoolExecutor):
     return [
         app.route("/api")(wrap_route(introspect, server, app=app)),
@@ -582,9 +666,13 @@ def register_api_routes(app: Flask, server: ServerContext, pool: DevicePoolExecu
             wrap_route(upscale, server, pool=pool)
         ),
         app.route("/api/chain", methods=["POST"])(wrap_route(chain, server, pool=pool)),
+        app.route("/api/upload", methods=["POST"])(
+            wrap_route(upload, server, pool=pool)
+        ),
         app.route("/api/blend", methods=["POST"])(wrap_route(blend, server, pool=pool)),
         app.route("/api/cancel", methods=["PUT"])(
             wrap_route(cancel, server, pool=pool)
         ),
         app.route("/api/ready")(wrap_route(ready, server, pool=pool)),
+        app.route("/api/ready/stream")(wrap_route(ready_stream, server, pool=pool)),
     ]
@@ -1,3 +1,4 @@
+from importlib.util import find_spec
 from logging import getLogger
 from os import environ, path
 from secrets import token_urlsafe
@@ -59,6 +60,11 @@ class ServerContext:
 
         self.cache = ModelCache(self.cache_limit)
 
+        # detect optional capabilities once, so pipeline loads do not pay for
+        # repeated failing imports
+        self.has_accelerate = find_spec("accelerate") is not None
+        self.has_xformers = find_spec("xformers") is not None
+
     @classmethod
     def from_environ(cls):
         memory_limit = environ.get("ONNX_WEB_MEMORY_LIMIT", None)
@@ -8,8 +8,10 @@ cache: List[Tuple[str, Any, Any]] = []
 
 
 class ModelTypes(str, Enum):
+    blended = "blended"
     correction = "correction"
     diffusion = "diffusion"
+    networks = "networks"
     scheduler = "scheduler"
     upscaling = "upscaling"
 
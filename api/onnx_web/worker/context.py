@@ -21,6 +21,7 @@ class WorkerContext:
     progress: "Queue[ProgressCommand]"
     last_progress: Optional[ProgressCommand]
     idle: "Value[bool]"
+    step: "Value[int]"
     timeout: float
 
     def __init__(
@@ -33,6 +34,7 @@ class WorkerContext:
         progress: "Queue[ProgressCommand]",
         active_pid: "Value[int]",
         idle: "Value[bool]",
+        step: "Value[int]",
     ):
         self.job = job
         self.device = device
@@ -43,10 +45,12 @@ class WorkerContext:
         self.active_pid = active_pid
         self.last_progress = None
         self.idle = idle
+        self.step = step
         self.timeout = 1.0
 
     def start(self, job: str) -> None:
         self.job = job
+        self.step.value = 0
         self.set_cancel(cancel=False)
         self.set_idle(idle=False)
 
@@ -106,10 +110,16 @@ class WorkerContext:
                 False,
             )
 
-            self.progress.put(
-                self.last_progress,
-                block=False,
-            )
+            # per-step updates go through the shared counter, which is a
+            # single lock-free store; the queue only carries the job start
+            # and terminal events, keeping pickle and pipe traffic off the
+            # sampler step path
+            self.step.value = progress
+            if progress == 0:
+                self.progress.put(
+                    self.last_progress,
+                    block=False,
+                )
 
     def finish(self) -> None:
         logger.debug("setting finished for job %s", self.job)
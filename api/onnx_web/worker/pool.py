@@ -1,9 +1,9 @@
-from collections import Counter
 from logging import getLogger
 from queue import Empty
 from threading import Lock, Thread
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
+import numpy as np
 from torch.multiprocessing import Process, Queue, Value
 
 from ..params import DeviceParams
@@ -30,6 +30,7 @@ class DevicePoolExecutor:
 
     worker_cancel: Dict[str, "Value[bool]"]
     worker_idle: Dict[str, "Value[bool]"]
+    worker_step: Dict[str, "Value[int]"]
 
     context: Dict[str, WorkerContext]  # Device -> Context
     current: Dict[str, "Value[int]"]  # Device -> pid
@@ -41,8 +42,8 @@ class DevicePoolExecutor:
     logger_worker: Thread
     progress_worker: Interval
 
-    cancelled_jobs: List[str]
-    finished_jobs: List[ProgressCommand]
+    cancelled_jobs: Set[str]
+    finished_jobs: Dict[str, ProgressCommand]  # Job -> last progress
     pending_jobs: List[JobCommand]
     running_jobs: Dict[str, ProgressCommand]  # Device -> job progress
     total_jobs: Dict[str, int]  # Device -> job count
@@ -75,13 +76,14 @@ class DevicePoolExecutor:
         self.progress = {}
         self.workers = {}
 
-        self.cancelled_jobs = []
-        self.finished_jobs = []
+        self.cancelled_jobs = set()
+        self.finished_jobs = {}
         self.pending_jobs = []
         self.running_jobs = {}
         self.total_jobs = {}
         self.worker_cancel = {}
         self.worker_idle = {}
+        self.worker_step = {}
 
         self.logs = Queue(self.max_pending_per_worker)
         self.rlock = Lock()
@@ -113,6 +115,7 @@ class DevicePoolExecutor:
 
         self.worker_cancel[name] = Value("B", False)
         self.worker_idle[name] = Value("B", False)
+        self.worker_step[name] = Value("i", 0)
 
         # create a new context and worker
         context = WorkerContext(
@@ -124,6 +127,7 @@ class DevicePoolExecutor:
             pending=self.pending[name],
             active_pid=current,
             idle=self.worker_idle[name],
+            step=self.worker_step[name],
         )
         self.context[name] = context
 
@@ -180,17 +184,16 @@ class DevicePoolExecutor:
                 if self.devices[i].device == needs_device.device:
                     return i
 
-        jobs = Counter(range(len(self.devices)))
-        jobs.update([self.pending[d.device].qsize() for d in self.devices])
-
-        queued = jobs.most_common()
+        # argmin over the queue depths picks the least-loaded device and
+        # breaks ties in favor of the first one
+        queued = np.fromiter(
+            (self.pending[d.device].qsize() for d in self.devices),
+            dtype=np.int32,
+            count=len(self.devices),
+        )
         logger.trace("jobs queued by device: %s", queued)
 
-        lowest_count = queued[-1][1]
-        lowest_devices = [d[0] for d in queued if d[1] == lowest_count]
-        lowest_devices.sort()
-
-        return lowest_devices[0]
+        return int(np.argmin(queued))
 
     def cancel(self, key: str) -> bool:
         """
@@ -199,10 +202,9 @@ class DevicePoolExecutor:
         should be cancelled on the next progress callback.
         """
 
-        for job in self.finished_jobs:
-            if job.job == key:
-                logger.debug("cannot cancel finished job: %s", key)
-                return False
+        if key in self.finished_jobs:
+            logger.debug("cannot cancel finished job: %s", key)
+            return False
 
         for job in self.pending_jobs:
             if job.name == key:
@@ -216,7 +218,7 @@ class DevicePoolExecutor:
             job = self.running_jobs[key]
             logger.info("cancelling job %s, active on device %s", key, job.device)
 
-        self.cancelled_jobs.append(key)
+        self.cancelled_jobs.add(key)
         return True
 
     def done(self, key: str) -> Tuple[bool, Optional[ProgressCommand]]:
@@ -229,10 +231,9 @@ class DevicePoolExecutor:
             logger.debug("checking status for running job: %s", key)
             return (False, self.running_jobs[key])
 
-        for job in self.finished_jobs:
-            if job.job == key:
-                logger.debug("checking status for finished job: %s", key)
-                return (False, job)
+        if key in self.finished_jobs:
+            logger.debug("checking status for finished job: %s", key)
+            return (False, self.finished_jobs[key])
 
         for job in self.pending_jobs:
             if job.name == key:
@@ -415,7 +416,7 @@ class DevicePoolExecutor:
                     job.cancelled,
                     job.failed,
                 )
-                for job in self.finished_jobs
+                for job in self.finished_jobs.values()
             ],
             "pending": [
                 (
@@ -465,13 +466,12 @@ class DevicePoolExecutor:
     def finish_job(self, progress: ProgressCommand):
         # move from running to finished
         logger.info("job has finished: %s", progress.job)
-        self.finished_jobs.append(progress)
+        self.finished_jobs[progress.job] = progress
         if progress.job in self.running_jobs:
             del self.running_jobs[progress.job]
 
         self.join_leaking()
-        if progress.job in self.cancelled_jobs:
-            self.cancelled_jobs.remove(progress.job)
+        self.cancelled_jobs.discard(progress.job)
 
     def update_job(self, progress: ProgressCommand):
         if progress.finished:
@@ -534,8 +534,17 @@ def logger_main(pool: DevicePoolExecutor, logs: "Queue[str]"):
 
     while True:
         try:
-            msg = logs.get(pool.join_timeout / 2)
-            logger.debug("received logs from worker: %s", msg)
+            # block for the first message, then drain whatever else has
+            # accumulated so each wakeup handles a batch
+            msgs = [logs.get(timeout=pool.join_timeout / 2)]
+            try:
+                while True:
+                    msgs.append(logs.get_nowait())
+            except Empty:
+                pass
+
+            for msg in msgs:
+                logger.debug("received logs from worker: %s", msg)
         except Empty:
             # logger worker should not generate more logs if it doesn't have any logs
             pass
@@ -577,6 +586,27 @@ def progress_main(pool: DevicePoolExecutor):
         except Exception:
             logger.exception("error in progress worker for device %s", device)
 
+    # per-step progress is written to a shared counter by the workers, so
+    # refresh the running jobs from there instead of per-step queue messages
+    for key, job in list(pool.running_jobs.items()):
+        context = pool.context.get(job.device)
+        if context is None:
+            continue
+
+        if key in pool.cancelled_jobs:
+            context.set_cancel()
+
+        step = context.step.value
+        if step != job.progress:
+            pool.running_jobs[key] = ProgressCommand(
+                job.job,
+                job.device,
+                False,
+                step,
+                job.cancelled,
+                job.failed,
+            )
+
     for device, context in pool.context.items():
         if context.is_idle():
             logger.trace("enqueueing next job for idle worker")
@@ -0,0 +1,43 @@
+from glob import glob
+from hashlib import sha256
+from os import path
+
+import cv2
+import numpy as np
+
+
+def main():
+    """
+    Convert the test ref PNGs into raw .npy arrays, which the release tests
+    prefer because they memory-map without a PNG decode. The arrays are saved
+    exactly as cv2 decodes them, so they compare directly against downloaded
+    results decoded the same way.
+
+    Also write a .sha256 sidecar with the digest of the raw PNG bytes, so the
+    release tests can short-circuit a byte-identical download without decoding
+    either side.
+    """
+    refs_path = path.join(path.dirname(__file__), "test-refs")
+    for png_path in sorted(glob(path.join(refs_path, "*.png"))):
+        npy_path = png_path[: -len(".png")] + ".npy"
+        sha_path = png_path[: -len(".png")] + ".sha256"
+
+        with open(png_path, "rb") as f:
+            png_data = f.read()
+
+        with open(sha_path, "w") as f:
+            f.write(sha256(png_data).hexdigest())
+
+        image = cv2.imdecode(
+            np.frombuffer(png_data, dtype=np.uint8), cv2.IMREAD_UNCHANGED
+        )
+        if image is None:
+            print("unable to read ref: %s" % (png_path))
+            continue
+
+        np.save(npy_path, image)
+        print("converted %s: %s" % (npy_path, image.shape))
+
+
+if __name__ == "__main__":
+    main()
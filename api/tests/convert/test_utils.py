@@ -0,0 +1,40 @@
+import unittest
+from unittest.mock import patch
+
+from onnx_web.convert.utils import load_cached_tensor, tensor_cache
+from onnx_web.server.context import ServerContext
+
+
+class LoadCachedTensorTests(unittest.TestCase):
+    def setUp(self):
+        tensor_cache.clear()
+
+    def test_alternating_networks_hit(self):
+        server = ServerContext(cache_limit=2)
+        tensors = {
+            "lora-a": {"a": 1},
+            "lora-b": {"b": 2},
+        }
+
+        with patch(
+            "onnx_web.convert.utils.load_tensor",
+            side_effect=lambda name, map_location=None: tensors[name],
+        ) as load:
+            for _i in range(3):
+                self.assertIs(load_cached_tensor(server, "lora-a"), tensors["lora-a"])
+                self.assertIs(load_cached_tensor(server, "lora-b"), tensors["lora-b"])
+
+        self.assertEqual(load.call_count, 2)
+
+    def test_cache_disabled(self):
+        server = ServerContext(cache_limit=0)
+
+        with patch(
+            "onnx_web.convert.utils.load_tensor",
+            side_effect=lambda name, map_location=None: {},
+        ) as load:
+            load_cached_tensor(server, "lora-a")
+            load_cached_tensor(server, "lora-a")
+
+        self.assertEqual(load.call_count, 2)
+        self.assertEqual(len(tensor_cache), 0)